@@ -0,0 +1,68 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import panel as pn
+from panel.io.state import set_curdoc
+
+
+class Superseded(Exception):
+    # raised inside a load once a newer request replaced it.
+    pass
+
+class LatestLoader():
+    # runs loads off the server thread, only results of the most recent request are applied.
+    def __init__(self, workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.future = None
+    def submit(self, load, apply, *args):
+        # load(check, *args) yields one or more results (e.g. a preview, then full detail) and calls check() between
+        # expensive steps. apply(result) runs on the server thread for every result that is still current.
+        doc = pn.state.curdoc
+        with self.lock:
+            self.generation += 1
+            if self.future is not None:
+                # queued requests never start, a running one stops at its next check.
+                self.future.cancel()
+            self.future = self.executor.submit(self.run, self.generation, doc, load, apply, args)
+            return self.future
+    def is_current(self, generation):
+        with self.lock:
+            return generation == self.generation
+    def check(self, generation):
+        if not self.is_current(generation):
+            raise Superseded()
+    def run(self, generation, doc, load, apply, args):
+        try:
+            for result in load(partial(self.check, generation), *args):
+                self.check(generation)
+                schedule(doc, partial(self.apply_current, generation, apply, result))
+        except Superseded:
+            pass
+        except Exception:
+            traceback.print_exc()
+    def apply_current(self, generation, apply, result):
+        # a newer request can arrive while this result waits for the server thread.
+        if self.is_current(generation):
+            apply(result)
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            if self.future is not None:
+                self.future.cancel()
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+def schedule(doc, callback):
+    # bokeh documents are only modified on their own event loop, without a server session the callback runs directly.
+    if doc is None:
+        callback()
+        return
+    doc.add_next_tick_callback(partial(run_in_document, doc, callback))
+
+def run_in_document(doc, callback):
+    with set_curdoc(doc):
+        callback()
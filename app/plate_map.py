@@ -4,9 +4,9 @@ import json
 import numpy as np
 import pandas as pd
 
-from plate_map_plots import  PlateMap, WellInfoTable, WellView, ExperimentData, SelectedWell
+from plate_map_plots import  PlateMap, WellInfoTable, WellView, ExperimentData, SelectedWell, cache_stats
 
-from wellplate.elements import read_plate_xml, read_nd2
+from wellplate.elements import read_plate_xml
 import holoviews as hv
 from matplotlib.colors import  to_hex
 from holoviews.operation.datashader import regrid
@@ -24,6 +24,7 @@ def get_app():
         exp_data.exp_names,exp_data.data_sets)
     # well view.
     well_view = WellView()
+    well_view.selected_well = selected_well
     well_view.bound = pn.bind(well_view.get_well_data, selected_well.param.ind)
     well_view.bound_exp = pn.bind(well_view.load_experiment_data, exp_data.param.current_exp_name,
         exp_data.exp_names,exp_data.data_sets)
@@ -34,9 +35,10 @@ def get_app():
 
     # Main image viewer.
     @pn.depends(well_view.param.redraw_flag)
-    def image_callback(**kwargs):
+    def image_callback(x_range=None, y_range=None, **kwargs):
+        well_view.set_view_range(x_range, y_range)
         return well_view.create_result_rgb()
-    img_dmap = hv.DynamicMap(image_callback)
+    img_dmap = hv.DynamicMap(image_callback, streams=[hv.streams.RangeXY()])
     regridded = regrid(img_dmap)
     display_obj = regridded.opts(width=700, height=700,aspect=1)
 
@@ -47,13 +49,20 @@ def get_app():
     app.header.append(pn.Row(exp_data.param.current_exp_name , pn.layout.HSpacer()))
     # Plate map.
     app.main.append(pn.Column(plate_map.bound,plate_map.param.conditions,))
-    app.main.append(pn.Row(pn.layout.HSpacer(),plate_map.view,pn.layout.HSpacer()))
+    app.main.append(pn.Row(pn.layout.HSpacer(),pn.pane.Bokeh(plate_map.figure),pn.layout.HSpacer()))
 
     # Image widgets.
     app.main.append(pn.Column(well_info_table.bound,well_info_table.param,well_info_table.view))
     app.main.append(pn.Row(pn.layout.HSpacer(),
     well_view.bound,well_view.bound_exp,
     well_view.channel_widgets,display_obj,pn.layout.HSpacer()))
+
+    # Shared cache statistics.
+    stats = pn.pane.JSON(cache_stats(), name='Cache', depth=1)
+    pn.state.add_periodic_callback(lambda: setattr(stats, 'object', cache_stats()), period=5000)
+    app.sidebar.append(pn.Column('### Shared Cache', stats))
+    # release this session's pins and loaders, the decoded data stays cached for other sessions.
+    pn.state.on_session_destroyed(lambda session_context: (well_view.close(), plate_map.close()))
     return app
 
 get_app().servable()
\ No newline at end of file
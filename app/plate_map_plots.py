@@ -2,72 +2,220 @@ import numpy as np
 import param
 from bokeh.models import ColumnDataSource
 from bokeh.plotting import figure
-from bokeh.palettes import Spectral6
-from bokeh.transform import factor_cmap
+from bokeh.palettes import Category10, Category20
 from bokeh.models import TapTool
 import panel as pn
 import pandas as pd
 import holoviews as hv
 import json
-from wellplate.elements import read_plate_xml, read_nd2
+import os
+import copy
+import threading
+from functools import lru_cache
+from pathlib import Path
+from wellplate.elements import read_plate_xml
+from wellplate.reader import open_plate
+from wellplate.pyramid import open_pyramid, choose_level, read_region
+from wellplate.composite import Compositor, color_table, label_color_table, channel_lut, label_lut
+from well_cache import WellCache
+from loaders import LatestLoader
+from wellplate.geometry import plate_geometry
 from matplotlib.colors import  to_hex,LinearSegmentedColormap
 import matplotlib.pyplot as plt
 import zarr
 import time
 
+# decoded wells and experiment metadata are shared by every session of the server process. the default capacity
+# can be set with the WELLPLATE_CACHE_BYTES environment variable.
+CACHE_BYTES = 4*2**30
+PREFETCH_WORKERS = 2
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def shared_cache(capacity_bytes=None):
+    # a capacity given after the cache exists resizes it for every session.
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            if capacity_bytes is None:
+                capacity_bytes = int(os.environ.get('WELLPLATE_CACHE_BYTES', CACHE_BYTES))
+            _shared_cache = WellCache(load_entry, capacity_bytes=capacity_bytes, prefetch_workers=PREFETCH_WORKERS)
+        elif capacity_bytes is not None:
+            _shared_cache.resize(capacity_bytes)
+        return _shared_cache
+
+def cache_stats():
+    return shared_cache().stats()
+
+def load_entry(key):
+    # keys hold everything needed to decode an entry, so any session can use it. they end with the version of the
+    # stored data, so a reprocessed plate is decoded again instead of served from the cache.
+    kind = key[0]
+    if kind == 'meta_data':
+        _, wellmap, mtime, plate_size = key
+        meta_data, _, labels = read_plate_xml(wellmap, plate_size)
+        return meta_data
+    if kind == 'plate':
+        _, nd2_file, processed_file, version = key
+        reader = open_plate(nd2_file)
+        processed = zarr.open(processed_file, mode='r')
+        return {'channel_names': list(reader.channel_names), 'colormaps': list(reader.colormaps),
+                'shape': tuple(reader.shape), 'pyramid': 'pyramid' in processed}
+    if kind == 'preview':
+        _, processed_file, well_ind, version = key
+        return decode_preview(open_pyramid(processed_file, well_ind))
+    _, nd2_file, processed_file, well_ind, region, display_size, version = key
+    return decode_region(nd2_file, processed_file, well_ind, region, display_size)
+
+def decode_region(nd2_file, processed_file, well_ind, region, display_size):
+    # decode a well (region) into display ready arrays.
+    if region is None:
+        # Grab data from the shared nd2 reader.
+        well_data = np.squeeze(open_plate(nd2_file).read(well_ind))
+        processed = zarr.open(processed_file, mode='r')
+        if 'cells/cell_masks' in processed:
+            mask_data = np.squeeze(processed['cells/cell_masks'][well_ind,:,:])
+        else:
+            mask_data = np.zeros(well_data.shape[1:], np.int32)
+        return read_only(well_data), read_only(mask_data)
+    well_pyramid = open_pyramid(processed_file, well_ind)
+    y0, y1, x0, x1 = region
+    level = choose_level(well_pyramid, (y1-y0, x1-x0), display_size)
+    well_data = read_region(well_pyramid, 'image', level, y0, y1, x0, x1)
+    if 'mask' in well_pyramid:
+        mask_data = read_region(well_pyramid, 'mask', level, y0, y1, x0, x1)
+    else:
+        mask_data = np.zeros(well_data.shape[1:], np.int32)
+    return read_only(well_data), read_only(mask_data)
+
+def decode_preview(well_pyramid):
+    # whole well from the coarsest pyramid level, a single chunk per channel.
+    height, width = well_pyramid.attrs['shape']
+    level = well_pyramid.attrs['levels']-1
+    well_data = read_region(well_pyramid, 'image', level, 0, height, 0, width)
+    if 'mask' in well_pyramid:
+        mask_data = read_region(well_pyramid, 'mask', level, 0, height, 0, width)
+    else:
+        mask_data = np.zeros(well_data.shape[1:], np.int32)
+    return read_only(well_data), read_only(mask_data)
+
+def read_only(array):
+    # cached arrays are shared between sessions, nothing may write to them.
+    array = np.ascontiguousarray(array)
+    array.setflags(write=False)
+    return array
+
+def path_mtime(path):
+    # directory mtimes change when zarr adds, replaces or removes the chunks and groups inside.
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def plate_version(nd2_file, processed_file):
+    return path_mtime(nd2_file), path_mtime(processed_file), path_mtime(Path(processed_file)/'pyramid')
+
+def read_data_sets(data_file='app/data.json'):
+    # every session gets its own copy of the parsed file, reparsed only when it changes.
+    return copy.deepcopy(parse_data_sets(str(data_file), os.stat(data_file).st_mtime_ns))
+
+@lru_cache(maxsize=4)
+def parse_data_sets(data_file, mtime):
+    with open(data_file) as f:
+        return json.load(f)['data_sets']
+
 class ExperimentData(param.Parameterized):
-        with open('app/data.json') as f:
-            data_info = json.load(f)
-        data_sets = data_info['data_sets']
-        exp_names = [loc['name'] for loc in data_sets]
-        current_exp_name = param.ObjectSelector(default=exp_names[0],objects=exp_names,label='Experiment Data')
+        current_exp_name = param.ObjectSelector(default=None,objects=[],label='Experiment Data')
+        def __init__(self, data_file='app/data.json', **params):
+            # read per session, not at import.
+            super().__init__(**params)
+            self.data_sets = read_data_sets(data_file)
+            self.exp_names = [loc['name'] for loc in self.data_sets]
+            # instance copy of the selector, sessions never share its objects.
+            self.param.current_exp_name.objects = self.exp_names
+            self.current_exp_name = self.exp_names[0]
 
 class SelectedWell(param.Parameterized):
     ind = param.Number(-1,precedence=-1)
+    related = param.List([],precedence=-1)
 
 class PlateMap(param.Parameterized):
         conditions = param.ObjectSelector(default='',objects=[''],label='Condition')
         meta_data = param.DataFrame(pd.DataFrame())
         selected_well = None
         well_size = 96
-        def view(self):
+        def __init__(self, **params):
+            super().__init__(**params)
+            # the figure is built once, experiment and condition changes only update its data source.
+            self.source = ColumnDataSource(dict(x=[], y=[], condition=[], color=[]))
+            self.loader = LatestLoader()
+            self.figure = self.create_figure()
+        def create_figure(self):
             p = figure(width=800, height=400,tools="tap")
             p.grid.visible = False
             p.toolbar.active_drag = None
             p.toolbar.active_scroll = None
-            if self.well_size == 96:
-                x = np.tile(np.arange(1,13),8)
-                y = (np.array([np.repeat(i,12)for i in range(8)])).flatten()
-                #adjust axis.
-                p.x_range.start, p.x_range.end = 0.5,14.5
-                p.y_range.start, p.y_range.end = 7.5,-0.5
-                p.yaxis.ticker = np.arange(0,9)
-                p.yaxis.major_label_overrides = {0: 'A', 1: 'B', 2: 'C',3:'D',4:'E',5:'F',6:'G',7:'H'}
-                p.xaxis.ticker = np.arange(1,13)
-
-            if self.conditions != '':
-                values = self.meta_data[self.conditions].unique()
-                source = ColumnDataSource(dict(x=x,y=y,condition = self.meta_data[self.conditions]))
-                p.circle('x','y', source=source, radius=0.3, alpha=0.5,
-                        fill_color=factor_cmap('condition', 'Category10_3', values),legend_field='condition')
-                p.legend.orientation = "vertical"
-                p.legend.location = "top_right"
-                # click interactions
-                p.select(type=TapTool)
-                source.selected.on_change('indices', self.change_selected_well)
+            p.circle('x','y', source=self.source, radius=0.3, alpha=0.5, fill_color='color', legend_field='condition')
+            p.legend.orientation = "vertical"
+            p.legend.location = "top_right"
+            # click interactions
+            p.select(type=TapTool)
+            self.source.selected.on_change('indices', self.change_selected_well)
             return p
+        def set_axes(self, geometry):
+            p = self.figure
+            p.x_range.start, p.x_range.end = 0.5,geometry.n_cols+2.5
+            p.y_range.start, p.y_range.end = geometry.n_rows-0.5,-0.5
+            p.yaxis.ticker = np.arange(0,geometry.n_rows+1)
+            p.yaxis.major_label_overrides = {i: name for i, name in enumerate(geometry.row_names)}
+            p.xaxis.ticker = np.arange(1,geometry.n_cols+1)
+        @param.depends('meta_data', 'conditions', watch=True)
+        def update_source(self):
+            if self.conditions not in self.meta_data:
+                return
+            values = [str(value) for value in self.meta_data[self.conditions]]
+            colors = condition_colors(values)
+            geometry = plate_geometry(self.well_size)
+            if len(self.source.data['x']) != len(values):
+                # new plate format: replace the data and axes of the same figure.
+                self.set_axes(geometry)
+                self.source.data = dict(x=geometry.cols+1, y=geometry.rows, condition=values, color=colors)
+            else:
+                # same wells, only their conditions change.
+                self.source.patch({'condition': [(slice(0, len(values)), values)], 'color': [(slice(0, len(values)), colors)]})
         def change_selected_well(self, attr, old, new):
             if len(new)>0:
+                # wells with the same condition are prefetched by the well view.
+                condition = self.meta_data[self.conditions].iloc[new[0]]
+                self.selected_well.related = [int(ind) for ind in np.flatnonzero(self.meta_data[self.conditions].to_numpy()==condition)]
                 self.selected_well.ind = new[0]
 
         def load_experiment_data(self,current_exp_name, exp_names, data_sets):
-            self.selected_flag = False
+            # the xml is parsed in the loader thread, an experiment switch replaces a load that is still running.
             data_index = exp_names.index(current_exp_name)
-            self.meta_data, _, labels = read_plate_xml(data_sets[data_index]['wellmap'])
+            self.loader.submit(self.read_meta_data, self.set_meta_data, data_sets[data_index])
+        def read_meta_data(self, check, data_set):
+            well_size = data_set.get('plate_size', 96)
+            wellmap = data_set['wellmap']
+            meta_data = shared_cache().get(('meta_data', wellmap, os.stat(wellmap).st_mtime_ns, well_size))
+            yield well_size, meta_data
+        def set_meta_data(self, result):
+            self.well_size, meta_data = result
             # Get conditions.
-            conditions = [ cond for cond in self.meta_data.columns[1:] if cond not in ['Note','Notes']]
+            conditions = [ cond for cond in meta_data.columns[1:] if cond not in ['Note','Notes']]
             self.param.conditions.objects = conditions
-            self.conditions = conditions[0]
+            # one source update for both changes.
+            self.param.update(meta_data=meta_data, conditions=conditions[0])
+        def close(self):
+            self.loader.shutdown()
+
+def condition_colors(values):
+    # palette color per condition in order of appearance, wells without a condition are gray.
+    factors = [value for value in dict.fromkeys(values) if value not in ['None', 'none']]
+    palette = Category10[10] if len(factors) <= 10 else Category20[20]
+    lookup = {factor: palette[i % len(palette)] for i, factor in enumerate(factors)}
+    return [lookup.get(value, '#d3d3d3') for value in values]
 
 class Channel():
     def __init__(self,name,colormap, enable, well_view):
@@ -77,99 +225,204 @@ class Channel():
         self.name = name
         self.colormap = colormap
         self.well_view = well_view
-        self.im_rgb = None
-        self.result_rgb = None
-        self.callback = None
-    def set_data(self, array):
-        self.range.start = array.min()
-        self.range.end = array.max()
-        #normalize.
-        norm_im = array/ (2**16)
-        # apply colormap.
-        self.im_rgb = self.colormap(norm_im)
-        # bind controls.
+        self.raw = None
+        self.lut = None
+        if colormap is not None:
+            self.color_table = color_table(colormap)
+        # bind controls once, new data only replaces the raw array.
         self.callback = pn.bind(self.set_img_range, self.enable, self.range, watch=True)
+    def set_data(self, array, bounds=True):
+        # keep the raw data, contrast and colormap are applied through the lut.
+        self.raw = array
+        if bounds:
+            # slider bounds follow the well, previews and zoomed regions keep them.
+            self.range.start = array.min()
+            self.range.end = array.max()
     def set_img_range(self, enable,range, redraw=True ):
-        if enable:
-            if self.im_rgb is not None:
-                # scale threshold to 0-1.
-                low_lim = (range[0]/2**16)
-                high_lim = (range[1]/2**16)
-                im = self.im_rgb
-                im = (im - low_lim) / (high_lim - low_lim)
-                self.result_rgb = im[:,:,:3]
+        if enable & (self.raw is not None):
+            # slider moves only rebuild the lut.
+            self.lut = channel_lut(self.color_table, range[0], range[1])
         else:
-            self.result_rgb = None
+            self.lut = None
         if redraw:
             self.well_view.redraw()
 
 class MaskChannel(Channel):
-    def set_data(self, array):
-        vals = np.linspace(0,1,10000)
-        np.random.shuffle(vals)
-        cmap = plt.cm.gist_rainbow(vals)
-        cmap[0,:] = [0,0,0,0]
-        cmap = plt.cm.colors.ListedColormap(cmap)
-        self.im_rgb = cmap(array/10000).astype('float')
-        self.callback = pn.bind(self.set_img_range, self.enable,0, watch=True)
+    def __init__(self, name, colormap, enable, well_view):
+        super().__init__(name, colormap, enable, well_view)
+        self.color_table = label_color_table()
+    def set_data(self, array, bounds=True):
+        self.raw = array
     def set_img_range(self, enable, range, redraw=True):
-        if enable:
-            if self.im_rgb is not None:
-                self.result_rgb = self.im_rgb[:,:,:3]
+        if enable & (self.raw is not None):
+            self.lut = label_lut(self.color_table, self.raw.max())
         else:
-            self.result_rgb = None
+            self.lut = None
         if redraw:
             self.well_view.redraw()
 
 class WellView(param.Parameterized):
-    xarr = None
-    cell_masks = None
-    im_size = [10,10]
-    well_change_callback = []
-    channels = []
-    channel_widgets = pn.Column()
+    display_size = (700,700)
+    prefetch_count = 12
     # 
     redraw_flag = param.Boolean(False,label='Enable Brightfield Channel', precedence=-1)
+    def __init__(self, **params):
+        super().__init__(**params)
+        # all mutable state is per session, decoded data comes from the process wide cache.
+        self.cache = shared_cache()
+        self.nd2_file = None
+        self.processed_file = None
+        self.has_pyramid = False
+        self.well_pyramid = None
+        self.view_region = None
+        self.shown_region = None
+        # cache entry on screen, pinned until something else is shown.
+        self.shown_key = None
+        self.compositor = None
+        self.plate_size = 96
+        self.selected_ind = None
+        self.selected_version = None
+        self.selected_well = None
+        self.im_size = [10,10]
+        self.channels = []
+        self.channel_widgets = pn.Column()
+        # experiment, well and region loads run off the server thread, a newer request supersedes a running one.
+        self.experiment_loader = LatestLoader()
+        self.well_loader = LatestLoader()
+        self.region_loader = LatestLoader()
     def redraw(self):
         self.redraw_flag = not self.redraw_flag
     def create_result_rgb(self):
-        result_im = np.zeros((self.im_size[0],self.im_size[1],3),np.float)
-        for channel in self.channels:
-            if channel.result_rgb is not None:
-                result_im += channel.result_rgb
-        im = np.clip(result_im,0,1)
+        # reuse the composite buffers while the image size stays the same.
+        if (self.compositor is None) or (self.compositor.shape != tuple(self.im_size)):
+            self.compositor = Compositor(self.im_size)
+        im = self.compositor.composite([(channel.raw, channel.lut) for channel in self.channels if channel.lut is not None])
+        if self.shown_region is not None:
+            # place the region in full resolution pixel coordinates (y pointing down).
+            y0, y1, x0, x1 = self.shown_region
+            return hv.RGB(im, bounds=(x0,-y1,x1,-y0)).opts(hooks=[self.hook])
         im = hv.RGB(im).opts(hooks=[self.hook])
         return im
+    def set_view_range(self, x_range, y_range):
+        # fetch the pyramid level and region that match the current viewport.
+        if (self.well_pyramid is None) or (x_range is None) or (y_range is None):
+            return
+        height, width = self.well_pyramid.attrs['shape']
+        region = (int(np.clip(-y_range[1],0,height)), int(np.clip(np.ceil(-y_range[0]),0,height)),
+                  int(np.clip(x_range[0],0,width)), int(np.clip(np.ceil(x_range[1]),0,width)))
+        if (region[1]>region[0]) & (region[3]>region[2]) & (region != self.view_region):
+            # the current image stays up (scaled) until the region is decoded.
+            self.view_region = region
+            self.region_loader.submit(self.load_region, self.show_region, self.selected_ind, region, self.selected_version)
     def hook(self, plot, element):
         fig = plot.state
         fig['layout']['xaxis_visible']=False
         fig['layout']['yaxis_visible']=False
         fig['layout']['xaxis_scaleanchor']="y"
         fig['layout']['xaxis_scaleratio']=1
+    def well_source(self, well_ind):
+        # pyramid, whole well region and data version of a well. wells missing from the pyramid (e.g. an interrupted
+        # build_pyramid) are decoded at full resolution from the raw file and stored masks.
+        well_pyramid = open_pyramid(self.processed_file, well_ind) if self.has_pyramid else None
+        if well_pyramid is None:
+            return None, None, (path_mtime(self.nd2_file), path_mtime(Path(self.processed_file)/'cells'/'cell_masks'))
+        height, width = well_pyramid.attrs['shape']
+        # the pyramid fingerprint changes with its mask.
+        return well_pyramid, (0, height, 0, width), well_pyramid.attrs.get('fingerprint')
+    def well_key(self, well_ind, region, version):
+        return ('well', self.nd2_file, self.processed_file, well_ind, region, self.display_size, version)
+    def load_region(self, check, well_ind, region, version):
+        key = self.well_key(well_ind, region, version)
+        yield well_ind, region, key, self.cache.get(key)
+    def show_region(self, result):
+        well_ind, region, key, data = result
+        if well_ind != self.selected_ind:
+            return
+        self.set_channel_data(region, key, data, bounds=False)
+        self.redraw()
+    def set_channel_data(self, region, key, data, bounds=True):
+        # pin what is shown, other sessions viewing the same well share it instead of decoding a copy.
+        self.cache.pin(key, data)
+        self.release_shown()
+        self.shown_key = key
+        well_data, mask_data = data
+        self.shown_region = region
+        self.im_size = [well_data.shape[1],well_data.shape[2]]
+        # attach to channels.
+        for i, channel in enumerate(self.channels):
+            if i!=len(self.channels)-1:
+                channel.set_data(well_data[i,:,:], bounds)
+            else:
+                channel.set_data(mask_data, bounds)
+            channel.set_img_range(channel.enable.value, channel.range.value,redraw=False)
+    def release_shown(self):
+        if self.shown_key is not None:
+            self.cache.release(self.shown_key)
+            self.shown_key = None
+    def prefetch_candidates(self, selected_well):
+        # plate neighbors first, then other wells with the same condition.
+        candidates = plate_geometry(self.plate_size).neighbors(selected_well)
+        if self.selected_well is not None:
+            candidates += [ind for ind in self.selected_well.related if ind not in candidates]
+        return [ind for ind in candidates if ind != selected_well][:self.prefetch_count]
     def get_well_data(self,selected_well):
-        if self.xarr is not None:
-            # Grab data from xarr.
-            well_data = np.squeeze(self.xarr[selected_well,:,:,:]).to_numpy().astype('float')
-            mask_data = np.squeeze(self.cell_masks[selected_well,:,:]).astype('float')
-            # attach to channels.
-            for i, channel in enumerate(self.channels):
-                if i!=len(self.channels)-1:         
-                    channel.set_data(np.squeeze(well_data[i,:,:]))
-                    channel.set_img_range(channel.enable.value, channel.range.value,redraw=False)
-                else:
-                    channel.set_data(np.squeeze(mask_data))
-                    channel.set_img_range(channel.enable.value, channel.range.value,redraw=False)
-            # trigger redraw
-            self.redraw()
+        if self.nd2_file is None:
+            return
+        selected_well = int(selected_well)
+        # drop this session's queued prefetches and region loads of the previous selection.
+        self.cache.cancel_prefetch(id(self))
+        self.region_loader.cancel()
+        self.well_loader.submit(self.load_well, self.show_well, selected_well)
+    def load_well(self, check, selected_well):
+        # runs in the loader thread: a coarse preview first, then the well at display resolution.
+        if self.has_pyramid & (selected_well < 0):
+            return
+        well_pyramid, region, version = self.well_source(selected_well)
+        key = self.well_key(selected_well, region, version)
+        if well_pyramid is not None:
+            # start from the whole well at the coarsest useful level.
+            levels = well_pyramid.attrs['levels']
+            if (key not in self.cache) & (choose_level(well_pyramid, (region[1], region[3]), self.display_size) < levels-1):
+                preview_key = ('preview', self.processed_file, selected_well, version)
+                yield selected_well, well_pyramid, region, version, preview_key, self.cache.get(preview_key), False
+                check()
+        yield selected_well, well_pyramid, region, version, key, self.cache.get(key), True
+        check()
+        # decode the wells that are likely to be opened next in the background, sources are read here off the server thread.
+        if selected_well >= 0:
+            sources = [(ind,)+self.well_source(ind) for ind in self.prefetch_candidates(selected_well)]
+            self.cache.prefetch([self.well_key(ind, region, version) for ind, _, region, version in sources], owner=id(self))
+    def show_well(self, result):
+        selected_well, well_pyramid, region, version, key, data, complete = result
+        self.selected_ind, self.well_pyramid, self.view_region, self.selected_version = selected_well, well_pyramid, region, version
+        # slider bounds are set from the well at display resolution, not from its preview.
+        self.set_channel_data(region, key, data, bounds=complete)
+        # trigger redraw
+        self.redraw()
     def load_experiment_data(self,current_exp_name, exp_names, data_sets):
+        # opening the plate and result store happens in the loader thread.
         data_index = exp_names.index(current_exp_name)
+        self.experiment_loader.submit(self.open_experiment, self.set_experiment, data_sets[data_index])
+    def open_experiment(self, check, data_set):
+        yield data_set, self.cache.get(('plate', data_set['nd2'], data_set['processed'], plate_version(data_set['nd2'], data_set['processed'])))
+    def set_experiment(self, result):
+        data_set, plate = result
+        # loads for the previous experiment are dropped, its cached wells stay for other sessions.
+        self.well_loader.cancel()
+        self.region_loader.cancel()
+        self.cache.cancel_prefetch(id(self))
+        self.release_shown()
+        self.selected_ind, self.selected_version, self.shown_region, self.view_region = None, None, None, None
         # load imaging data.
-        self.xarr, names, colormaps = read_nd2(data_sets[data_index]['nd2'])
-        self.im_size = [self.xarr.shape[2],self.xarr.shape[3]]
-        # load cell masks.
-        self.cell_masks = zarr.open(data_sets[data_index]['processed'])['cells/cell_masks'].astype('float')
+        self.nd2_file, self.processed_file = data_set['nd2'], data_set['processed']
+        names, colormaps = plate['channel_names'], plate['colormaps']
+        self.im_size = [plate['shape'][2],plate['shape'][3]]
+        self.plate_size = data_set.get('plate_size', 96)
+        # prefer the multiscale pyramid when it was built for this plate.
+        self.well_pyramid = None
+        self.has_pyramid = plate['pyramid']
         # create channels.
-        self.channels.clear()
+        self.channels = []
         for channel, channel_name in enumerate(names):
             default_enable =True
             if (channel_name == 'Bright Field'):
@@ -186,6 +439,14 @@ class WellView(param.Parameterized):
         mask_channel = self.channels[-1]
         self.channel_widgets.append( pn.Column(mask_channel.enable, background= f'#88888888'))
         self.channel_widgets.append(pn.Column(pn.Spacer(height=5)))
+    def close(self):
+        # session ended: its pin and queued prefetches go, decoded wells stay cached for others.
+        self.experiment_loader.shutdown()
+        self.well_loader.shutdown()
+        self.region_loader.shutdown()
+        self.cache.cancel_prefetch(id(self))
+        self.release_shown()
+        self.channels = []
 
 
 class WellInfoTable(param.Parameterized):
@@ -0,0 +1,147 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import numpy as np
+import pandas as pd
+
+
+def value_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, dict):
+        return sum(value_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_nbytes(item) for item in value)
+    return 0
+
+class WellCache():
+    # byte bounded LRU cache of decoded wells with background prefetching, shared by every session of the server.
+    # entries pinned by a session are never evicted, concurrent requests for one key decode it once.
+    def __init__(self, loader, capacity_bytes=2*2**30, prefetch_workers=1):
+        self.loader = loader
+        self.capacity_bytes = capacity_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.pins = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # decodes in progress, later requests for the same key wait on them.
+        self.loading = {}
+        # prefetches that have not started yet, per owner (session).
+        self.queued = {}
+        self.executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            future = self.loading.get(key)
+            if future is None:
+                future = Future()
+                self.loading[key] = future
+                self.misses += 1
+                load = True
+            else:
+                self.hits += 1
+                load = False
+        if not load:
+            return future.result()
+        try:
+            value = self.loader(key)
+        except BaseException as error:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self.insert(key, value)
+        future.set_result(value)
+        return value
+    def pin(self, key, value):
+        # a session shows this value, keep it shared while any session holds it (the memory is in use anyway).
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0)+1
+            if key not in self.entries:
+                self.insert(key, value)
+    def resize(self, capacity_bytes):
+        with self.lock:
+            self.capacity_bytes = capacity_bytes
+            self.evict(0)
+    def release(self, key):
+        # drop one pin, the entry becomes evictable once no session holds it.
+        with self.lock:
+            count = self.pins.get(key, 0)-1
+            if count > 0:
+                self.pins[key] = count
+                return
+            self.pins.pop(key, None)
+            self.evict(0)
+    def insert(self, key, value):
+        size = value_nbytes(value)
+        if key in self.entries:
+            return
+        if (size > self.capacity_bytes) and (key not in self.pins):
+            return
+        self.evict(size)
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.nbytes += size
+    def evict(self, size):
+        # least recently used unpinned entries go first, pinned entries may keep the cache over capacity.
+        for key in [key for key in self.entries if key not in self.pins]:
+            if self.nbytes+size <= self.capacity_bytes:
+                break
+            del self.entries[key]
+            self.nbytes -= self.sizes.pop(key)
+            self.evictions += 1
+    def prefetch(self, keys, owner=None):
+        with self.lock:
+            # drop queued prefetches from the owner's previous selection.
+            for future in self.queued.pop(owner, {}).values():
+                future.cancel()
+            queued = self.queued.setdefault(owner, {})
+            for key in keys:
+                if (key not in self.entries) and (key not in self.loading) and (key not in queued):
+                    queued[key] = self.executor.submit(self.prefetch_load, key, owner)
+    def prefetch_load(self, key, owner):
+        try:
+            value = self.get(key)
+            with self.lock:
+                self.prefetches += 1
+            return value
+        finally:
+            with self.lock:
+                self.queued.get(owner, {}).pop(key, None)
+    def cancel_prefetch(self, owner=None):
+        with self.lock:
+            for future in self.queued.pop(owner, {}).values():
+                future.cancel()
+    def clear(self):
+        with self.lock:
+            for queued in self.queued.values():
+                for future in queued.values():
+                    future.cancel()
+            self.queued.clear()
+            for key in [key for key in self.entries if key not in self.pins]:
+                del self.entries[key]
+                self.nbytes -= self.sizes.pop(key)
+    def stats(self):
+        with self.lock:
+            requests = self.hits+self.misses
+            pinned = [key for key in self.pins if key in self.entries]
+            return {'entries': len(self.entries), 'nbytes': self.nbytes, 'capacity_bytes': self.capacity_bytes,
+                    'pinned_entries': len(pinned), 'pinned_nbytes': sum(self.sizes[key] for key in pinned),
+                    'loading': len(self.loading), 'queued': sum(len(queued) for queued in self.queued.values()),
+                    'hits': self.hits, 'misses': self.misses, 'prefetches': self.prefetches, 'evictions': self.evictions,
+                    'hit_rate': self.hits/requests if requests > 0 else 0.0}
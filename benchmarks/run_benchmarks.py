@@ -0,0 +1,149 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import zarr
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import wellplate.extract as extract
+from wellplate.background import background_stats
+from wellplate.composite import Compositor, channel_lut, color_table, label_color_table, label_lut
+from wellplate.fingerprint import code_version
+from synthetic import CHANNELS, synthetic_plate, write_synthetic_plate, plate_meta_data, synthetic_reader
+
+# (well size in pixels, cells per well).
+SIZES = {'small': (1024, 250), 'medium': (2048, 1000), 'large': (4096, 4000)}
+
+
+def measure(func, repeat=1):
+    # best wall time over repeats and peak traced memory of a single call.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak/2**20}, result
+
+def bench_mask_io(plate, output):
+    def run():
+        for well_ind, labels in enumerate(plate['labels']):
+            extract.write_mask(output.require_group('bench'), well_ind, CHANNELS[0], labels)
+        return [output[f'bench/cells/masks/well {well_ind}/channel {CHANNELS[0]}'][:] for well_ind in range(len(plate['labels']))]
+    return run
+
+def bench_intensities(nd2_file):
+    def run():
+        for channel in CHANNELS[1:]:
+            extract.calculate_intensities_channel(nd2_file, CHANNELS[0], channel, redo=True, callbacks=[])
+    return run
+
+def bench_features(plate):
+    def run():
+        return [extract.label_features(labels, plate['im_data'][well_ind, 1:].to_numpy())
+                for well_ind, labels in enumerate(plate['labels'])]
+    return run
+
+def bench_background(plate):
+    def run():
+        return [background_stats(labels, plate['im_data'][well_ind, 1].to_numpy(), tile_size=512, percentiles=(5, 95))
+                for well_ind, labels in enumerate(plate['labels'])]
+    return run
+
+def bench_ratios(nd2_file, meta_data):
+    def run():
+        return extract.calculate_scaffold_epi_ratios(nd2_file, meta_data, CHANNELS[1], CHANNELS[2], callbacks=[])
+    return run
+
+def bench_compositing(plate):
+    # WellView style composite of every channel and the cell mask, one frame per well.
+    compositor = Compositor(plate['labels'][0].shape)
+    luts = [channel_lut(color_table(colormap), 0, 10000) for colormap in plate['colormaps']]
+    label_table = label_color_table(seed=0)
+    def run():
+        for well_ind, labels in enumerate(plate['labels']):
+            layers = [(plate['im_data'].values[well_ind, c], lut) for c, lut in enumerate(luts)]
+            layers.append((labels, label_lut(label_table, labels.max())))
+            compositor.composite(layers)
+    return run
+
+def feature_error(plate):
+    # largest deviation of measured cell means from the ground truth intensities.
+    errors = []
+    for well_ind, labels in enumerate(plate['labels']):
+        morphology, features, _ = extract.label_features(labels, plate['im_data'][well_ind].to_numpy())
+        truth = plate['intensities'][well_ind][morphology[:, 0].astype(int)-1]
+        errors.append(np.abs(features[:, :, extract.FEATURE_COLUMNS.index('mean')].T-truth).max())
+    return float(max(errors))
+
+def run_size(name, n_wells, repeat, folder):
+    well_size, n_cells = SIZES[name]
+    print(f'Generating {n_wells} synthetic wells of {well_size}x{well_size} with {n_cells} cells')
+    plate = synthetic_plate(n_wells, (well_size, well_size), n_cells)
+    nd2_file = write_synthetic_plate(plate, folder, name)
+    output = zarr.open(extract.nd2_file_2_zarr_result_file(nd2_file))
+    meta_data = plate_meta_data(n_wells)
+    stages = {'mask_io': bench_mask_io(plate, output), 'features': bench_features(plate),
+              'background': bench_background(plate), 'intensities': bench_intensities(nd2_file),
+              'ratios': bench_ratios(nd2_file, meta_data), 'compositing': bench_compositing(plate)}
+    results = {}
+    with synthetic_reader(plate, nd2_file):
+        for stage, func in stages.items():
+            results[stage], _ = measure(func, repeat)
+            results[stage]['wells_per_second'] = n_wells/results[stage]['seconds']
+            print(f"  {stage:12s} {results[stage]['seconds']:8.3f} s {results[stage]['peak_mb']:9.1f} MB peak")
+    return {'well_size': well_size, 'n_cells': n_cells, 'n_wells': n_wells,
+            'max_mean_error': feature_error(plate), 'stages': results}
+
+def compare(results, baseline, tolerance):
+    # relative change in time per stage, positive is slower than the baseline.
+    regressions = []
+    for size, size_results in results['sizes'].items():
+        if size not in baseline['sizes']:
+            continue
+        for stage, stage_results in size_results['stages'].items():
+            base = baseline['sizes'][size]['stages'].get(stage)
+            if base is None:
+                continue
+            change = stage_results['seconds']/base['seconds']-1
+            memory_change = stage_results['peak_mb']/max(base['peak_mb'], 1e-6)-1
+            flag = 'SLOWER' if change > tolerance else ('faster' if change < -tolerance else '')
+            print(f'{size:8s} {stage:12s} {change*100:+7.1f}% time {memory_change*100:+7.1f}% memory {flag}')
+            if change > tolerance:
+                regressions.append((size, stage))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages on synthetic plates')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES))
+    parser.add_argument('--wells', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_results.json', help='json file the results are written to')
+    parser.add_argument('--compare', default=None, help='baseline json to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    folder = Path(tempfile.mkdtemp(prefix='wellplate_bench_'))
+    try:
+        results = {'python': platform.python_version(), 'numpy': np.__version__, 'code_version': code_version(),
+                   'machine': platform.machine(), 'sizes': {}}
+        for size in args.sizes:
+            results['sizes'][size] = run_size(size, args.wells, args.repeat, folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f'Wrote {args.output}')
+    if args.compare is not None:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
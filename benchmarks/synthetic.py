@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+import wellplate.extract as extract
+from wellplate.fingerprint import stamp
+from wellplate.geometry import plate_geometry
+from wellplate.reader import ArrayReader, channel_colormap, register_reader, release_plate
+
+CHANNELS = ['365 nm', '488 nm', '640 nm']
+COLORS = [[0, 0, 1], [0, 1, 0], [1, 0, 0]]
+
+
+def blob_labels(shape, n_cells, radius, rng):
+    # elliptical nuclei at random positions, later blobs cover earlier ones where they overlap.
+    labels = np.zeros(shape, np.int32)
+    centers = rng.uniform([radius, radius], [shape[0]-radius, shape[1]-radius], size=(n_cells, 2))
+    radii = rng.uniform(0.6, 1.0, size=(n_cells, 2))*radius
+    for label, ((cy, cx), (ry, rx)) in enumerate(zip(centers, radii), start=1):
+        y0, y1 = max(int(cy-ry), 0), min(int(np.ceil(cy+ry))+1, shape[0])
+        x0, x1 = max(int(cx-rx), 0), min(int(np.ceil(cx+rx))+1, shape[1])
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        inside = ((yy-cy)/ry)**2+((xx-cx)/rx)**2 <= 1
+        labels[y0:y1, x0:x1][inside] = label
+    # relabel so ground truth only holds cells that are still visible.
+    present = np.unique(labels)
+    return np.searchsorted(present, labels).astype(np.int32), present.size-1
+
+def synthetic_well(shape, n_cells, n_channels=len(CHANNELS), radius=8, background=300, noise=20, seed=None):
+    # uint16 channels with known per cell intensities on a constant background.
+    rng = np.random.default_rng(seed)
+    labels, n_cells = blob_labels(shape, n_cells, radius, rng)
+    intensities = rng.uniform(500, 20000, size=(n_channels, n_cells+1))
+    intensities[:, 0] = 0
+    image = np.empty((n_channels,)+tuple(shape), np.uint16)
+    for c in range(n_channels):
+        plane = intensities[c][labels]+background+rng.normal(0, noise, size=shape)
+        image[c] = np.clip(plane, 0, 2**16-1)
+    return image, labels, intensities[:, 1:].T+background
+
+def synthetic_plate(n_wells, shape, n_cells, seed=0):
+    # in memory plate with the same layout as read_nd2 output plus ground truth labels and intensities.
+    images, labels, intensities = [], [], []
+    for well_ind in range(n_wells):
+        image, well_labels, well_intensities = synthetic_well(shape, n_cells, seed=seed+well_ind)
+        images.append(image)
+        labels.append(well_labels)
+        intensities.append(well_intensities)
+    im_data = xr.DataArray(np.stack(images), dims=['P', 'C', 'Y', 'X'])
+    colormaps = [channel_colormap(tuple(color)) for color in COLORS]
+    return {'im_data': im_data, 'channels': list(CHANNELS), 'colormaps': colormaps, 'labels': labels, 'intensities': intensities}
+
+def write_synthetic_plate(plate, folder, name='synthetic'):
+    # placeholder nd2 file so result paths and fingerprints work, plus ground truth masks in the result zarr.
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    nd2_file = folder/f'{name}.nd2'
+    nd2_file.write_text(f"synthetic plate {plate['im_data'].shape}")
+    output = zarr.open(extract.nd2_file_2_zarr_result_file(nd2_file))
+    output.require_group('cells/masks')
+    for well_ind, labels in enumerate(plate['labels']):
+        stamp(extract.write_array(output, Path(f'cells/masks/well {well_ind}/channel {CHANNELS[0]}'), labels,
+                                  chunks=(5000, 5000), dtype='i4'), 'synthetic')
+    return nd2_file
+
+def plate_meta_data(n_wells, plate_size=96):
+    ids = plate_geometry(plate_size).ind_to_id(np.arange(n_wells))
+    return pd.DataFrame({'well': ids, 'condition': [f'condition {i % 4}' for i in range(n_wells)]})
+
+@contextmanager
+def synthetic_reader(plate, nd2_file):
+    # serve the synthetic plate wherever the pipeline opens nd2_file in this process.
+    register_reader(nd2_file, ArrayReader(plate['im_data'], plate['channels'], COLORS))
+    try:
+        yield
+    finally:
+        release_plate(nd2_file)
@@ -7,5 +7,6 @@ setup(
     author = 'Johan Winnubst',
     author_email = 'winnubstj@janelia.hhmi.org',
     packages = ['wellplate'],
+    entry_points = {'console_scripts': ['wellplate=wellplate.cli:main']},
     zip_safe = False
 )
\ No newline at end of file
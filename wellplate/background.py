@@ -0,0 +1,72 @@
+import numpy as np
+
+N_LEVELS = 2**16
+BACKGROUND_COLUMNS = ['mean', 'std', 'median', 'mad']
+
+
+def strip_histogram(mask_strip, image_strip):
+    # foreground pixels are shifted into the upper half of a doubled histogram, so no boolean index copy is made.
+    index = (np.asarray(mask_strip) != 0).astype(np.int32)
+    index <<= 16
+    index += np.asarray(image_strip, dtype=np.uint16)
+    return np.bincount(index.ravel(), minlength=2*N_LEVELS)[:N_LEVELS]
+
+def background_stats(mask, image, tile_size=None, percentiles=(), strip_rows=1024):
+    # mask and image can be numpy, zarr or lazy xarray arrays, they are read one strip at a time.
+    if tile_size is not None:
+        strip_rows = tile_size
+    shape = mask.shape
+    hist = np.zeros(N_LEVELS, np.int64)
+    tile_stats = [] if tile_size is not None else None
+    for y0 in range(0, shape[0], strip_rows):
+        mask_strip = np.asarray(mask[y0:y0+strip_rows, :])
+        image_strip = np.asarray(image[y0:y0+strip_rows, :])
+        strip_hist, row_stats = strip_background(mask_strip, image_strip, tile_size, percentiles)
+        hist += strip_hist
+        if tile_stats is not None:
+            tile_stats.append(row_stats)
+    return background_result(hist, tile_stats, percentiles)
+
+def strip_background(mask_strip, image_strip, tile_size=None, percentiles=()):
+    # background histogram of a strip and, with tiles, the statistics of every tile in it.
+    if tile_size is None:
+        return strip_histogram(mask_strip, image_strip), None
+    # local background per tile, the plate wide histogram is the sum of the tiles.
+    hist = np.zeros(N_LEVELS, np.int64)
+    row_stats = []
+    for x0 in range(0, mask_strip.shape[1], tile_size):
+        tile_hist = strip_histogram(mask_strip[:, x0:x0+tile_size], image_strip[:, x0:x0+tile_size])
+        hist += tile_hist
+        row_stats.append(histogram_stats(tile_hist, percentiles))
+    return hist, row_stats
+
+def background_result(hist, tile_stats, percentiles=()):
+    stats = histogram_stats(hist, percentiles)
+    if tile_stats is None:
+        return stats, None
+    return stats, np.array(tile_stats)
+
+def histogram_stats(hist, percentiles=()):
+    # exact statistics of uint16 data from its histogram, ordered as BACKGROUND_COLUMNS + percentiles.
+    levels = np.arange(hist.size, dtype=np.float64)
+    count = hist.sum()
+    if count == 0:
+        return np.full(len(BACKGROUND_COLUMNS)+len(percentiles), np.nan)
+    mean = (hist*levels).sum()/count
+    std = np.sqrt((hist*(levels-mean)**2).sum()/count)
+    median = histogram_percentile(levels, hist, 50)
+    # median absolute deviation from the histogram of deviations.
+    deviations = np.abs(levels-median)
+    order = np.argsort(deviations, kind='stable')
+    mad = histogram_percentile(deviations[order], hist[order], 50)
+    return np.array([mean, std, median, mad]+[histogram_percentile(levels, hist, q) for q in percentiles])
+
+def histogram_percentile(sorted_values, counts, q):
+    # same linear interpolation as np.percentile on the expanded data.
+    cumulative = np.cumsum(counts)
+    rank = q/100*(cumulative[-1]-1)
+    lower, upper = np.searchsorted(cumulative, [np.floor(rank), np.ceil(rank)], side='right')
+    return sorted_values[lower]+(sorted_values[upper]-sorted_values[lower])*(rank-np.floor(rank))
+
+def percentile_columns(percentiles):
+    return BACKGROUND_COLUMNS+[f'p{q:g}' for q in percentiles]
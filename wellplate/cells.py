@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import zarr
+from wellplate.reader import open_plate
+from wellplate.extract import nd2_file_2_zarr_result_file, cell_index, write_cell_index, INDEX_COLUMNS
+from wellplate.fingerprint import run_id
+
+INDEX_TYPES = {'label': 'int64', 'area': 'int64', 'y0': 'int64', 'x0': 'int64', 'y1': 'int64', 'x1': 'int64'}
+
+
+def read_cell_index(nd2_file, well_ind, cell_channel):
+    # label -> bounding box, centroid and area. rebuilt from the mask when missing or older than the mask.
+    output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+    mask_path = f'cells/masks/well {well_ind}/channel {cell_channel}'
+    index_path = f'cells/index/well {well_ind}/channel {cell_channel}'
+    if mask_path not in output:
+        raise KeyError(f'No mask stored for well {well_ind} channel {cell_channel}')
+    if (index_path in output) and (output[index_path].attrs.get('mask') == run_id(output, mask_path)):
+        array = output[index_path]
+    else:
+        array = write_cell_index(output, well_ind, cell_channel, cell_index(output[mask_path][:]))
+    return pd.DataFrame(array[:], columns=INDEX_COLUMNS).astype(INDEX_TYPES)
+
+def cells_in_rect(nd2_file, well_ind, cell_channel, y0, y1, x0, x1, contained=False):
+    # cells whose bounding box overlaps the rectangle, or lies completely inside it.
+    index = read_cell_index(nd2_file, well_ind, cell_channel)
+    if contained:
+        inside = (index['y0'] >= y0) & (index['y1'] <= y1) & (index['x0'] >= x0) & (index['x1'] <= x1)
+    else:
+        inside = (index['y0'] < y1) & (index['y1'] > y0) & (index['x0'] < x1) & (index['x1'] > x0)
+    return index[inside].reset_index(drop=True)
+
+def cell_crops(nd2_file, well_ind, cell_channel, labels, channels=None, padding=8):
+    # image and mask around each cell, every crop reads only the chunks under its bounding box.
+    index = read_cell_index(nd2_file, well_ind, cell_channel).set_index('label')
+    cells = index.loc[np.atleast_1d(labels)].reset_index()
+    return [region_crops(nd2_file, well_ind, cell_channel, cells.iloc[[i]], channels, padding)[0] for i in range(len(cells))]
+
+def rect_crops(nd2_file, well_ind, cell_channel, y0, y1, x0, x1, channels=None, padding=8, contained=False):
+    # crops of every cell in a rectangle, cut from a single read of the region they cover.
+    cells = cells_in_rect(nd2_file, well_ind, cell_channel, y0, y1, x0, x1, contained)
+    if len(cells) == 0:
+        return []
+    return region_crops(nd2_file, well_ind, cell_channel, cells, channels, padding)
+
+def region_crops(nd2_file, well_ind, cell_channel, cells, channels=None, padding=8):
+    reader = open_plate(nd2_file)
+    masks = zarr.open(nd2_file_2_zarr_result_file(nd2_file), mode='r')[f'cells/masks/well {well_ind}/channel {cell_channel}']
+    height, width = masks.shape
+    boxes = np.stack([np.maximum(cells['y0']-padding, 0), np.maximum(cells['x0']-padding, 0),
+                      np.minimum(cells['y1']+padding, height), np.minimum(cells['x1']+padding, width)], axis=1)
+    ry0, rx0 = boxes[:, :2].min(axis=0)
+    ry1, rx1 = boxes[:, 2:].max(axis=0)
+    image = reader.read(well_ind, channels, ry0, ry1, rx0, rx1)
+    mask = masks[ry0:ry1, rx0:rx1]
+    crops = []
+    for label, (y0, x0, y1, x1) in zip(cells['label'], boxes):
+        crops.append({'label': int(label), 'y0': int(y0), 'x0': int(x0),
+                      'image': image[..., y0-ry0:y1-ry0, x0-rx0:x1-rx0], 'mask': mask[y0-ry0:y1-ry0, x0-rx0:x1-rx0] == label})
+    return crops
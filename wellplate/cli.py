@@ -0,0 +1,114 @@
+import argparse
+from pathlib import Path
+import pandas as pd
+from wellplate.jobs import JobQueue, run_queue, ratio_file, read_plate_metadata
+from wellplate.segmentation import ENGINES, CLASSICAL_TILE_SIZE
+from wellplate.transcode import transcode_plate
+from wellplate.export import export_cells
+
+METADATA_SUFFIXES = ['.xml', '.csv']
+
+
+def find_plates(source):
+    # a manifest csv with nd2 and metadata columns, or a directory of nd2 files with same stem metadata files.
+    source = Path(source)
+    if source.is_file():
+        manifest = pd.read_csv(source)
+        plates = []
+        for row in manifest.to_dict('records'):
+            nd2_file = (source.parents[0]/row['nd2']).resolve()
+            metadata = row.get('metadata')
+            metadata = None if pd.isna(metadata) else (source.parents[0]/metadata).resolve()
+            plates.append((row.get('name', nd2_file.stem), nd2_file, metadata))
+        return plates
+    plates = []
+    for nd2_file in sorted(source.glob('*.nd2')):
+        metadata = [nd2_file.with_suffix(suffix) for suffix in METADATA_SUFFIXES if nd2_file.with_suffix(suffix).exists()]
+        plates.append((nd2_file.stem, nd2_file.resolve(), metadata[0].resolve() if metadata else None))
+    return plates
+
+def plate_params(args):
+    tile_size = args.tile_size
+    if (args.engine == 'classical') and (tile_size is None):
+        tile_size = CLASSICAL_TILE_SIZE
+    return {'cell_channel': args.cell_channel, 'int_channels': [args.scaffold_channel, args.epi_channel],
+            'scaffold_channel': args.scaffold_channel, 'epi_channel': args.epi_channel,
+            'threshold_factor': args.threshold_factor, 'plate_size': args.plate_size, 'gpu': False if args.cpu else None,
+            'segment': {'flow_threshold': args.flow_threshold, 'cellprob_threshold': args.cellprob_threshold,
+                        'diameter': args.diameter, 'tile_size': tile_size, 'tile_overlap': args.tile_overlap,
+                        'model_type': args.model_type, 'engine': args.engine, 'engine_params': None},
+            'background': {'tile_size': args.background_tile_size, 'percentiles': []}}
+
+def run(args):
+    queue = JobQueue(args.queue, max_attempts=args.max_attempts)
+    recovered = queue.recover()
+    if recovered > 0:
+        print(f'Resuming {recovered} interrupted job(s)')
+    if args.retry_failed:
+        queue.retry_failed()
+    params = plate_params(args)
+    plates = find_plates(args.source)
+    for name, nd2_file, metadata in plates:
+        if args.transcode:
+            print(f'Transcoded {name} to {transcode_plate(nd2_file, workers=args.transcode_workers)}')
+        n_wells = queue.add_plate(name, nd2_file, metadata, params)
+        print(f'Queued {name}: {n_wells} wells, metadata {metadata}')
+    status = run_queue(queue, {'segment': args.segment_workers, 'features': args.feature_workers, 'ratios': args.ratio_workers})
+    print(status.to_string(index=False))
+    # combined ratio table over every finished plate in the queue.
+    ratio_files = [ratio_file(queue.plate(name)) for name, nd2_file, metadata in plates]
+    ratios = [pd.read_csv(file) for file in ratio_files if file.exists()]
+    if len(ratios) > 0:
+        combined = Path(args.queue).with_name('ratios.csv')
+        pd.concat(ratios, ignore_index=True).to_csv(combined, index=False)
+        print(f'Wrote ratios for {len(ratios)} plate(s) to {combined}')
+    if args.export is not None:
+        # per cell dataset of every plate that finished.
+        finished = [queue.plate(name) for name, nd2_file, metadata in plates if ratio_file(queue.plate(name)).exists()]
+        export_cells([(plate['name'], plate['nd2'], read_plate_metadata(plate['metadata'], args.plate_size)) for plate in finished],
+                     args.export, format=args.export_format, plate_size=args.plate_size)
+        print(f'Exported cells of {len(finished)} plate(s) to {args.export}')
+    return 0 if (status['status'] != 'failed').all() else 1
+
+def status(args):
+    print(JobQueue(args.queue).status().to_string(index=False))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wellplate', description='Batch processing of well plate ND2 files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='queue plates and process every well until done')
+    run_parser.add_argument('source', help='directory of .nd2 files or manifest csv with nd2 and metadata columns')
+    run_parser.add_argument('--queue', default='wellplate_jobs.sqlite', help='job queue database, reused to resume')
+    run_parser.add_argument('--cell-channel', default='365 nm')
+    run_parser.add_argument('--scaffold-channel', default='488 nm')
+    run_parser.add_argument('--epi-channel', default='640 nm')
+    run_parser.add_argument('--threshold-factor', type=float, default=0.5)
+    run_parser.add_argument('--plate-size', type=int, default=96)
+    run_parser.add_argument('--flow-threshold', type=float, default=0.9)
+    run_parser.add_argument('--cellprob-threshold', type=float, default=-5)
+    run_parser.add_argument('--diameter', type=float, default=None)
+    run_parser.add_argument('--tile-size', type=int, default=None)
+    run_parser.add_argument('--tile-overlap', type=int, default=128)
+    run_parser.add_argument('--engine', default='cellpose', choices=list(ENGINES), help='segmentation engine')
+    run_parser.add_argument('--model-type', default='nuclei')
+    run_parser.add_argument('--cpu', action='store_true', help='run Cellpose on the CPU even when a GPU is available')
+    run_parser.add_argument('--background-tile-size', type=int, default=512)
+    run_parser.add_argument('--transcode', action='store_true', help='copy each ND2 to a chunked zarr first, faster for repeat analysis')
+    run_parser.add_argument('--transcode-workers', type=int, default=4)
+    run_parser.add_argument('--segment-workers', type=int, default=1)
+    run_parser.add_argument('--feature-workers', type=int, default=4)
+    run_parser.add_argument('--ratio-workers', type=int, default=1)
+    run_parser.add_argument('--max-attempts', type=int, default=2)
+    run_parser.add_argument('--export', default=None, help='write per cell results of finished plates to this partitioned dataset')
+    run_parser.add_argument('--export-format', default='parquet', choices=['parquet', 'arrow'])
+    run_parser.add_argument('--retry-failed', action='store_true', help='requeue jobs that ran out of attempts')
+    run_parser.set_defaults(func=run)
+    status_parser = subparsers.add_parser('status', help='show job counts per plate and stage')
+    status_parser.add_argument('--queue', default='wellplate_jobs.sqlite')
+    status_parser.set_defaults(func=status)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main())
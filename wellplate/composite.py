@@ -0,0 +1,47 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+N_LEVELS = 2**16
+
+
+def color_table(colormap, n_colors=256):
+    # sample a matplotlib colormap into a small uint8 RGB table.
+    return np.round(colormap(np.linspace(0, 1, n_colors))[:, :3]*255).astype(np.uint8)
+
+def label_color_table(n_colors=10000, seed=None):
+    # shuffled rainbow colors for label images, label 0 stays black.
+    vals = np.linspace(0, 1, n_colors)
+    np.random.default_rng(seed).shuffle(vals)
+    table = np.round(plt.cm.gist_rainbow(vals)[:, :3]*255).astype(np.uint8)
+    table[0, :] = 0
+    return table
+
+def channel_lut(table, low, high, n_levels=N_LEVELS):
+    # contrast window and colormap folded into one uint8 lookup per raw intensity.
+    levels = np.arange(n_levels, dtype=np.float32)
+    index = np.clip((levels-low)*((table.shape[0]-1)/max(high-low, 1)), 0, table.shape[0]-1)
+    return table[index.astype(np.intp)]
+
+def label_lut(table, max_label):
+    # label colors repeat every table.shape[0] labels.
+    labels = np.arange(int(max_label)+1)
+    lut = table[labels % table.shape[0]]
+    lut[0, :] = 0
+    return lut
+
+class Compositor():
+    # additive RGB compositing into preallocated buffers.
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.accumulator = np.zeros(self.shape+(3,), np.uint16)
+        self.layer = np.zeros(self.shape+(3,), np.uint8)
+        self.result = np.zeros(self.shape+(3,), np.uint8)
+    def composite(self, layers):
+        # layers are (raw data, lut) pairs, raw data is used as an index into its lut.
+        self.accumulator[:] = 0
+        for raw, lut in layers:
+            np.take(lut, raw, axis=0, out=self.layer, mode='clip')
+            np.add(self.accumulator, self.layer, out=self.accumulator)
+        np.minimum(self.accumulator, 255, out=self.accumulator)
+        self.result[:] = self.accumulator
+        return self.result
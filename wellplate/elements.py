@@ -1,37 +1,117 @@
 import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
-import nd2
-from matplotlib.colors import LinearSegmentedColormap
 import csv
+import os
+import copy
+from functools import lru_cache
+from wellplate.geometry import plate_geometry
+from wellplate.reader import open_plate
 
 
-def read_plate_xml(file_loc):
-    # get tree
-    tree = ET.parse(file_loc)
-    root = tree.getroot()
-    # get active preset.
-    preset_index = int(root.find("Presets/PresetIndex").text)
-    # read all label info.
-    labels = read_labels(root,preset_index)
-    # read all meta data.
-    meta_data,meta_data_info = read_meta_data(root,preset_index)
+def read_plate_xml(file_loc, plate_size=96):
+    # parsed tables are memoized per file path + modification time.
+    mtime = os.stat(file_loc).st_mtime_ns
+    meta_data, meta_data_info, labels = parse_plate_xml(str(file_loc), mtime, plate_size)
+    return meta_data.copy(), copy.deepcopy(meta_data_info), labels.copy()
+
+@lru_cache(maxsize=32)
+def parse_plate_xml(file_loc, mtime, plate_size=96):
+    # single streaming pass, every preset is collected since the active one may be declared last.
+    geometry = plate_geometry(plate_size)
+    preset_index = None
+    presets = {}
+    path = []
+    elems = []
+    current = {}
+    for event, elem in ET.iterparse(file_loc, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            elems.append(elem)
+            continue
+        tags = path[1:]
+        if tags == ['Presets', 'PresetIndex']:
+            preset_index = int(elem.text)
+        elif (len(tags) == 1) and tags[0].startswith('WellplateMetadata_'):
+            # presets without labels or quantities still exist.
+            presets.setdefault(int(tags[0].split('_')[-1]), {'labels': {}, 'quantities': []})
+        elif (len(tags) >= 3) and tags[0].startswith('WellplateMetadata_'):
+            preset = presets.setdefault(int(tags[0].split('_')[-1]), {'labels': {}, 'quantities': []})
+            section = tags[1:]
+            if section[:2] == ['Labels', 'Label']:
+                if section[2:] == ['Name']:
+                    current['name'] = elem.text
+                elif section[2:] == ['Color']:
+                    current['color'] = elem.text
+                elif section[2:] == ['Wells', 'WellIndex']:
+                    current.setdefault('wells', []).append(int(elem.text))
+                elif len(section) == 2:
+                    # labels with the same name are merged, the first color is kept.
+                    label = preset['labels'].setdefault(current.get('name'), {'tag_color': current.get('color'), 'wells': []})
+                    label['wells'].extend(current.get('wells', []))
+                    current = {}
+            elif section[:2] == ['Quantities', 'Quantity']:
+                if section[2:] == ['Name']:
+                    current['name'] = elem.text
+                elif section[2:] == ['Desc']:
+                    current['desc'] = elem.text
+                elif section[2:] == ['Wells', 'Well', 'WellIndex']:
+                    current['well_index'] = int(elem.text)
+                elif section[2:] == ['Wells', 'Well', 'Quality']:
+                    current['quality'] = elem.text
+                elif section[2:] == ['Wells', 'Well']:
+                    if 'quality' in current:
+                        current.setdefault('values', {})[current['well_index']] = current['quality']
+                    current.pop('well_index', None)
+                    current.pop('quality', None)
+                elif len(section) == 2:
+                    preset['quantities'].append(current)
+                    current = {}
+        path.pop()
+        elems.pop()
+        # every finished element is dropped from the tree, memory does not grow with the file.
+        elem.clear()
+        if len(elems) > 0:
+            elems[-1].remove(elem)
+    if preset_index is None:
+        raise ValueError(f'No PresetIndex in {file_loc}')
+    if preset_index not in presets:
+        raise ValueError(f'Preset {preset_index} not found in {file_loc}')
+    preset = presets[preset_index]
+    # labels table.
+    labels = []
+    for name, label in preset['labels'].items():
+        label_wells_ind = np.unique(np.array(label['wells'], dtype=int))
+        labels.append({'name': name, 'tag_color': label['tag_color'], 'well_indices': label_wells_ind,
+                       'well_ids': geometry.ind_to_id(label_wells_ind).tolist()})
+    labels = pd.DataFrame(labels, columns=['name', 'tag_color', 'well_indices', 'well_ids'])
+    # quantities table.
+    meta_data = pd.DataFrame([])
+    meta_data['well'] = geometry.ids
+    meta_data_info = []
+    for quantity in preset['quantities']:
+        meta_data_info.append({'name': quantity.get('name'), 'desc': quantity.get('desc')})
+        meta_wells = np.full(plate_size, 'None', dtype=object)
+        values = quantity.get('values', {})
+        meta_wells[list(values.keys())] = list(values.values())
+        meta_data[quantity.get('name')] = meta_wells
     return meta_data, meta_data_info, labels
 
-def read_plate_csv(file_loc):
+def read_plate_csv(file_loc, plate_size=96):
+    geometry = plate_geometry(plate_size)
     with open(file_loc, 'r') as file:
         # find labels
         meta_data= pd.DataFrame()
-        meta_data['well'] = [well_ind_to_id(i) for i in range(96)]
+        meta_data['well'] = geometry.ids
         values=[]
         read_values = False
         read_lines = 0
         reader = csv.reader(file)
         for i, row in enumerate(reader):
             if read_values:
-                values.append(row[start_ind:start_ind+12])
+                values.append(row[start_ind:start_ind+geometry.n_cols])
                 read_lines+=1
-                if read_lines==8:
+                if read_lines==geometry.n_rows:
                     meta_data[name] = np.array(values).flatten()
                     read_lines=0
                     read_values=False
@@ -43,10 +123,11 @@ def read_plate_csv(file_loc):
                 read_values=True # start reading values on next line
     return meta_data
 
-def read_plate_gsheet(gc, file_name, tab_name, label_word='SELECTION'):
+def read_plate_gsheet(gc, file_name, tab_name, label_word='SELECTION', plate_size=96):
+    geometry = plate_geometry(plate_size)
     meta_data = pd.DataFrame([])
     # get well IDs.
-    meta_data['well'] = [ well_ind_to_id(i) for i in range(96)]
+    meta_data['well'] = geometry.ids
     # get data.
     data = np.array(gc.open(file_name).worksheet(tab_name).get_all_values())
     # get labels
@@ -54,30 +135,32 @@ def read_plate_gsheet(gc, file_name, tab_name, label_word='SELECTION'):
     # get values.
     for label_ind in label_indices:
         name = data[label_ind[0], label_ind[1]+1]
-        values = data[label_ind[0]+1: label_ind[0]+9, label_ind[1]:label_ind[1]+12]
+        values = data[label_ind[0]+1: label_ind[0]+1+geometry.n_rows, label_ind[1]:label_ind[1]+geometry.n_cols]
         values[values=='']='none'
         #store.
         meta_data[name] = values.flatten()
     return meta_data
 
-def read_labels(root, preset_index):
+def read_labels(root, preset_index, plate_size=96):
+    geometry = plate_geometry(plate_size)
     labels = []
     for elem in root.findall(f"./WellplateMetadata_{preset_index}/Labels/"):
         # get tag info.
         label_name = elem.find('Name').text
         label_color = elem.find('Color').text
         # get well info.
-        search_str = f"./WellplateMetadata_1/Labels/Label[Name='{label_name}']/Wells/WellIndex"
-        label_wells_ind = np.unique(np.array([int(elem.text) for elem in root.findall(search_str)]))
-        label_wells_id = [well_ind_to_id(ind) for ind in label_wells_ind]
+        search_str = f"./WellplateMetadata_{preset_index}/Labels/Label[Name='{label_name}']/Wells/WellIndex"
+        label_wells_ind = np.unique(np.array([int(elem.text) for elem in root.findall(search_str)], dtype=int))
+        label_wells_id = geometry.ind_to_id(label_wells_ind).tolist()
         labels.append({'name':label_name, 'tag_color':label_color,'well_indices':label_wells_ind,'well_ids':label_wells_id})
     labels = pd.DataFrame(labels).drop_duplicates(subset='name')
     return labels
 
-def read_meta_data(root, preset_index):
+def read_meta_data(root, preset_index, plate_size=96):
+    geometry = plate_geometry(plate_size)
     meta_data = pd.DataFrame([])
     # get well IDs.
-    meta_data['well'] = [ well_ind_to_id(i) for i in range(96)]
+    meta_data['well'] = geometry.ids
     meta_data_info = []
     for elem in root.findall(f"./WellplateMetadata_{preset_index}/Quantities/Quantity"):
         # get meta info.
@@ -85,7 +168,7 @@ def read_meta_data(root, preset_index):
         meta_desc = elem.find('Desc').text
         meta_data_info.append({'name':meta_name,'desc':meta_desc})
         # get value each well.
-        meta_wells = ['None' for i in range(96)]
+        meta_wells = np.full(plate_size, 'None', dtype=object)
         for well in elem.findall('Wells/Well'):
             well_index = int(well.find('WellIndex').text)
             quality = well.find('Quality')
@@ -95,25 +178,11 @@ def read_meta_data(root, preset_index):
         meta_data[meta_name] = meta_wells
     return meta_data, meta_data_info
 
-def well_ind_to_id(ind):
-    row_col = np.unravel_index(ind,(8,12))
-    letters = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-    well_id = f"{letters[row_col[0]]}{row_col[1]+1}"
-    return well_id
+def well_ind_to_id(ind, plate_size=96):
+    # works on single indices and on arrays of indices.
+    return plate_geometry(plate_size).ind_to_id(ind)
 
 def read_nd2(file_loc):
-    colormaps = []
-    names = []
-    with nd2.ND2File(file_loc) as f:
-        for channel in f.metadata.channels:
-            name = channel.channel.name
-            r = (channel.channel.colorRGB & 0xff)/255
-            g = ((channel.channel.colorRGB & 0xff00) >> 8)/255
-            b = ((channel.channel.colorRGB & 0xff0000) >> 16)/255
-            a = 1
-            colors = [[0,0,0],[r,g,b]]
-            # process colormaps. 
-            colormaps.append(LinearSegmentedColormap.from_list('testCmap', colors, N=2**16))
-            names.append(name)
-        xarr = f.to_xarray(delayed=True)
-    return xarr, names, colormaps
\ No newline at end of file
+    # the file stays open in the reader pool, channel names and colormaps are parsed once per file.
+    reader = open_plate(file_loc)
+    return reader.to_xarray(), list(reader.channel_names), reader.colormaps
\ No newline at end of file
@@ -0,0 +1,74 @@
+import operator
+from functools import reduce
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+from wellplate.extract import nd2_file_2_zarr_result_file
+from wellplate.elements import well_ind_to_id
+from wellplate.table import build_cell_table, open_cell_table, read_cells
+
+# file format per dataset format, arrow (ipc) files are read without decoding.
+FORMATS = {'parquet': 'parquet', 'arrow': 'ipc'}
+# rows are sorted by well, so small row groups let well and plate filters skip most of a file.
+ROWS_PER_GROUP = 2**16
+PARTITIONING = ds.partitioning(pa.schema([('plate', pa.string())]), flavor='hive')
+
+
+def plate_cells(nd2_file, meta_data=None, plate=None, plate_size=96):
+    # one row per cell: plate, well, features, the well background of every channel and the well's metadata.
+    result_file = nd2_file_2_zarr_result_file(nd2_file)
+    table = open_cell_table(result_file)
+    if table is None:
+        build_cell_table(result_file)
+        table = open_cell_table(result_file)
+    cells = read_cells(result_file, table=table)
+    well_inds = cells['well_ind'].to_numpy()
+    for channel in table.attrs['channels']:
+        background = table[f'background/{channel}'][:]
+        cells[f'{channel} background'] = background[well_inds, 0]
+        cells[f'{channel} background std'] = background[well_inds, 1]
+    cells.insert(0, 'well', well_ind_to_id(well_inds, plate_size))
+    cells.insert(0, 'plate', plate if plate is not None else Path(nd2_file).stem)
+    if meta_data is not None:
+        # metadata is stored as text so the same column has one type across plates.
+        cells = cells.merge(meta_data.astype(str), on='well', how='left')
+    return cells
+
+def export_cells(plates, dataset_dir, format='parquet', plate_size=96):
+    # plates are (name, nd2_file, meta_data) tuples, every plate replaces its own plate=<name> partition.
+    for name, nd2_file, meta_data in plates:
+        cells = pa.Table.from_pandas(plate_cells(nd2_file, meta_data, name, plate_size), preserve_index=False)
+        ds.write_dataset(cells, str(dataset_dir), format=FORMATS[format], partitioning=PARTITIONING,
+                         basename_template=f'part-{{i}}.{format}', existing_data_behavior='delete_matching',
+                         max_rows_per_group=ROWS_PER_GROUP, min_rows_per_group=min(ROWS_PER_GROUP, cells.num_rows))
+    return Path(dataset_dir)
+
+def open_cells(dataset_dir, format='parquet'):
+    # memory mapped files, plates with different metadata columns are read with the union of their schemas.
+    filesystem = fs.LocalFileSystem(use_mmap=True)
+    dataset = ds.dataset(str(dataset_dir), format=FORMATS[format], partitioning=PARTITIONING, filesystem=filesystem)
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()]+[PARTITIONING.schema])
+    return ds.dataset(str(dataset_dir), schema=schema, format=FORMATS[format], partitioning=PARTITIONING, filesystem=filesystem)
+
+def cell_filter(plates=None, wells=None, where=None, ranges=None):
+    # where maps metadata columns to allowed values, ranges maps numeric columns to inclusive (low, high), None is open.
+    filters = []
+    if plates is not None:
+        filters.append(ds.field('plate').isin([str(plate) for plate in np.atleast_1d(plates)]))
+    if wells is not None:
+        filters.append(ds.field('well').isin([str(well) for well in np.atleast_1d(wells)]))
+    for column, values in (where or {}).items():
+        filters.append(ds.field(column).isin([str(value) for value in np.atleast_1d(values)]))
+    for column, (low, high) in (ranges or {}).items():
+        if low is not None:
+            filters.append(ds.field(column) >= low)
+        if high is not None:
+            filters.append(ds.field(column) <= high)
+    return reduce(operator.and_, filters) if len(filters) > 0 else None
+
+def query_cells(dataset_dir, columns=None, plates=None, wells=None, where=None, ranges=None, format='parquet'):
+    # filters are pushed down to partitions and row groups, only the requested columns are read.
+    dataset = open_cells(dataset_dir, format)
+    return dataset.to_table(columns=columns, filter=cell_filter(plates, wells, where, ranges)).to_pandas()
@@ -1,11 +1,18 @@
+import os
+import time
 from pathlib import Path
 import zarr
 import pandas as pd
-from wellplate.elements import read_nd2, well_ind_to_id
-from cellpose import models
-from tqdm.notebook import tqdm
-import shutil
-from skimage.measure import regionprops,label
+from numcodecs import Blosc
+from wellplate.elements import well_ind_to_id
+from wellplate.reader import open_plate
+from wellplate.parallel import map_wells, wells_in_flight
+from wellplate.segmentation import segment_images, tile_params, mask_agreement, CLASSICAL_TILE_SIZE
+from wellplate.instrument import stage, default_callbacks, MetricsCollector, save_metrics
+from wellplate.tiling import segment_tiled
+from wellplate.fingerprint import fingerprint, is_current, stamp, run_id
+from wellplate.table import build_cell_table, invalidate_cell_table, open_cell_table, local_cell_background
+from wellplate.background import strip_background, background_result, percentile_columns, N_LEVELS
 import numpy as np
 
 def nd2_file_2_zarr_result_file(nd2_file):
@@ -13,85 +20,544 @@ def nd2_file_2_zarr_result_file(nd2_file):
   nd2_file = Path(nd2_file)
   return nd2_file.parents[0]/f"{nd2_file.stem}.zarr"
 
-def run_cellpose(nd2_file, cell_channel, flow_threshold=0.9, cellprob_threshold=-5, diameter=None, redo=False):
+def run_cellpose(nd2_file, cell_channel, flow_threshold=0.9, cellprob_threshold=-5, diameter=None, redo=False,
+                 workers=1, memory_gb=None, tile_size=None, tile_overlap=128, callbacks=None, model_type='nuclei', gpu=None,
+                 batch_wells=1, batch_tiles=1, batch_size=8, engine='cellpose', engine_params=None):
   result_file = nd2_file_2_zarr_result_file(nd2_file)
   output = zarr.open(result_file)
   # read nd2 file.
-  im_data, channel_names, colormaps = read_nd2(nd2_file)
-  print(f"Preparing to run Cellpose on channel {cell_channel} for {im_data.shape[0]} wells")
-  channel_ind = channel_names.index(cell_channel)
-  model = models.Cellpose(gpu=True, model_type="nuclei")
-  for well_ind in tqdm(range(im_data.shape[0]), desc='Processing well'):
-    # check if data is already present, unless redo is requested.
-    mask_path = Path(f'cells/masks/well {well_ind}/channel {cell_channel}')
-    if (mask_path not in output) | redo==True:
-      # remove previous data if present.
-      if (mask_path in output) & redo==True: shutil.rmtree(result_file/mask_path)
-      # run cellpose.
-      im=im_data[well_ind,channel_ind,:,:].to_numpy()
-      masks, flows, styles, diams = model.eval(im,diameter=diameter, flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold)
-      # store mask data.
-      well_group = output.require_group(mask_path.parents[0])
-      array = well_group.require_dataset(mask_path.name,data=masks,shape = masks.shape,chunks=(5000,5000), dtype='i2')
-
-def calculate_intensities_channel(nd2_file, cell_channel, int_channel, redo=False):
+  reader = open_plate(nd2_file)
+  print(f"Preparing to run {engine} segmentation on channel {cell_channel} for {reader.shape[0]} wells")
+  if (engine == 'classical') and (tile_size is None):
+    # the classical engine is chunk parallel, tiles of a well are segmented in threads.
+    tile_size = CLASSICAL_TILE_SIZE
+  # only recompute masks whose inputs changed, unless redo is requested.
+  mask_fp = mask_fingerprint(nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, tile_size, tile_overlap, model_type,
+                             engine, engine_params)
+  well_inds = [well_ind for well_ind in range(reader.shape[0])
+               if (not is_current(output, f'cells/masks/well {well_ind}/channel {cell_channel}', mask_fp)) | redo==True]
+  if len(well_inds) > 0:
+    # the plate table was built from the masks about to be replaced, it is rebuilt with the features.
+    invalidate_cell_table(result_file)
+  # create shared groups up front so workers only write their own well group.
+  output.require_group('cells/masks')
+  output.require_group('cells/index')
+  well_nbytes = plane_nbytes(reader)*CELLPOSE_MEMORY_FACTOR
+  if tile_size is not None:
+    # peak memory is bounded by the tile including its overlap.
+    well_nbytes = (tile_size+2*tile_overlap)**2*reader.dtype.itemsize*CELLPOSE_MEMORY_FACTOR*batch_tiles
+  elif batch_wells > 1:
+    well_nbytes *= batch_wells
+  # cpu threads are split between the wells in flight.
+  threads = max(1, (os.cpu_count() or 1)//wells_in_flight(workers, memory_gb, well_nbytes))
+  model_params = engine_model_params(engine, engine_params, model_type, gpu, threads, batch_size)
+  if engine == 'classical':
+    batch_tiles = max(batch_tiles, threads)
+  metrics = MetricsCollector()
+  callbacks = default_callbacks(callbacks)+[metrics]
+  if (tile_size is None) and (batch_wells > 1):
+    # several wells per eval call, each batch is keyed by its first well.
+    batches = {batch[0]: batch for batch in [well_inds[i:i+batch_wells] for i in range(0, len(well_inds), batch_wells)]}
+    results, timings = map_wells(cellpose_batch, list(batches),
+                                 (batches, nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, mask_fp, model_params),
+                                 workers=workers, memory_gb=memory_gb, well_nbytes=well_nbytes, desc='Processing batch', callbacks=callbacks)
+  else:
+    results, timings = map_wells(cellpose_well, well_inds,
+                                 (nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, tile_size, tile_overlap, mask_fp,
+                                  model_params, batch_tiles),
+                                 workers=workers, memory_gb=memory_gb, well_nbytes=well_nbytes, callbacks=callbacks)
+  save_metrics(output, 'masks', metrics)
+  return timings
+
+def mask_fingerprint(nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, tile_size=None, tile_overlap=128, model_type='nuclei',
+                     engine='cellpose', engine_params=None):
+  return fingerprint(nd2_file, 'masks', STAGE_VERSIONS['masks'], channel=cell_channel, flow_threshold=flow_threshold,
+                     cellprob_threshold=cellprob_threshold, diameter=diameter, tile_size=tile_size, tile_overlap=tile_overlap,
+                     model_type=model_type, engine=engine, engine_params=engine_params)
+
+def engine_model_params(engine='cellpose', engine_params=None, model_type='nuclei', gpu=None, threads=None, batch_size=8):
+  # everything a worker needs to build the segmentation function besides the cellpose thresholds.
+  if engine == 'cellpose':
+    return {'engine': engine, 'model_type': model_type, 'gpu': gpu, 'threads': threads, 'batch_size': batch_size}
+  return dict(engine_params or {}, engine=engine, threads=threads)
+
+def segment_function(flow_threshold, cellprob_threshold, diameter, model_params=None):
+  params = dict(model_params or {})
+  engine = params.pop('engine', 'cellpose')
+  if engine == 'cellpose':
+    params.update(flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold)
+  return lambda ims: segment_images(ims, engine, diameter=diameter, **params)
+
+def cellpose_well(well_ind, nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, tile_size=None, tile_overlap=128, mask_fp=None,
+                  model_params=None, batch_tiles=1):
+  if tile_size is None:
+    return cellpose_batch(well_ind, {well_ind: [well_ind]}, nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, mask_fp, model_params)
+  output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+  reader = open_plate(nd2_file)
+  mask_path = Path(f'cells/masks/well {well_ind}/channel {cell_channel}')
+  # stream overlapping tiles and write the stitched mask chunk by chunk.
+  shape = reader.shape[-2:]
+  well_group = output.require_group(mask_path.parents[0].as_posix())
+  # the label count is only known after stitching, so tiled masks use the widest label dtype and rely on compression.
+  masks = well_group.create_dataset(mask_path.name, shape=shape, chunks=(tile_size,tile_size), dtype='u4', compressor=COMPRESSOR, overwrite=True)
+  read_region = lambda y0, y1, x0, x1: reader.read(well_ind, cell_channel, y0, y1, x0, x1)
+  model_params = dict(model_params or {})
+  with stage('prepare'):
+    model_params = tile_params(model_params.get('engine', 'cellpose'), model_params, lambda: strided_sample(read_region, shape, tile_size))
+  segment = segment_function(flow_threshold, cellprob_threshold, diameter, model_params)
+  # reads, inference and writes interleave per tile, so the well is a single stage.
+  with stage('segment_tiled'):
+    n_labels = segment_tiled(read_region, segment, shape, masks, tile_size=tile_size, overlap=tile_overlap, batch_tiles=batch_tiles)
+  stamp(masks, mask_fp)
+  with stage('index'):
+    write_cell_index(output, well_ind, cell_channel, cell_index(masks, n_labels+1))
+
+def strided_sample(read_region, shape, tile_size, step=4):
+  # every step-th pixel of the well, read a tile at a time so the whole plane is never in memory.
+  # tiles are aligned to the stride, so the sample equals plane[::step, ::step].
+  tile_size = max(step, tile_size//step*step)
+  sample = None
+  for y0 in range(0, shape[0], tile_size):
+    for x0 in range(0, shape[1], tile_size):
+      tile = np.asarray(read_region(y0, min(y0+tile_size, shape[0]), x0, min(x0+tile_size, shape[1])))[::step, ::step]
+      if sample is None:
+        sample = np.empty((-(-shape[0]//step), -(-shape[1]//step)), tile.dtype)
+      sample[y0//step:y0//step+tile.shape[0], x0//step:x0//step+tile.shape[1]] = tile
+  return sample
+
+def cellpose_batch(batch_ind, batches, nd2_file, cell_channel, flow_threshold, cellprob_threshold, diameter, mask_fp=None, model_params=None):
+  output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+  reader = open_plate(nd2_file)
+  well_inds = batches[batch_ind]
+  with stage('read'):
+    ims = list(reader.read_wells(well_inds, cell_channel))
+  # segment all wells of the batch in one call, models are loaded once per process.
+  with stage('segment'):
+    masks = segment_function(flow_threshold, cellprob_threshold, diameter, model_params)(ims)
+  # store mask data.
+  with stage('write'):
+    for well_ind, well_masks in zip(well_inds, masks):
+      write_mask(output, well_ind, cell_channel, well_masks, mask_fp)
+
+def label_dtype(max_label):
+  # smallest unsigned type that holds every label of a well.
+  for dtype in ['u1', 'u2', 'u4']:
+    if max_label <= np.iinfo(dtype).max:
+      return dtype
+  return 'u8'
+
+def write_mask(output, well_ind, cell_channel, mask_im, mask_fp=None, chunk_size=None):
+  # compressed mask in square chunks plus its cell index, so single cells are read a few chunks at a time.
+  chunk_size = chunk_size or MASK_CHUNK_SIZE
+  mask_im = np.asarray(mask_im)
+  masks = write_array(output, Path(f'cells/masks/well {well_ind}/channel {cell_channel}'), mask_im, chunks=(chunk_size,chunk_size),
+                      dtype=label_dtype(int(mask_im.max(initial=0))), compressor=COMPRESSOR)
+  stamp(masks, mask_fp)
+  write_cell_index(output, well_ind, cell_channel, cell_index(mask_im))
+  return masks
+
+def write_cell_index(output, well_ind, cell_channel, index):
+  # records the run id of the mask it was built from, readers rebuild it when they differ.
+  array = write_array(output, Path(f'cells/index/well {well_ind}/channel {cell_channel}'), index, INDEX_COLUMNS, dtype='f8')
+  array.attrs['mask'] = run_id(output, f'cells/masks/well {well_ind}/channel {cell_channel}')
+  return array
+
+def segment_image(im, flow_threshold, cellprob_threshold, diameter, model_params=None, tile_size=None, tile_overlap=128, batch_tiles=1):
+  # segment one plane that is already in memory, with the same tiling and stitching as run_cellpose.
+  if tile_size is None:
+    return segment_function(flow_threshold, cellprob_threshold, diameter, model_params)([im])[0]
+  labels = np.zeros(im.shape, np.int32)
+  model_params = dict(model_params or {})
+  well_params = tile_params(model_params.get('engine', 'cellpose'), model_params, lambda: im[::4, ::4])
+  segment_tiled(lambda y0, y1, x0, x1: im[y0:y1, x0:x1], segment_function(flow_threshold, cellprob_threshold, diameter, well_params),
+                im.shape, labels, tile_size=tile_size, overlap=tile_overlap, batch_tiles=batch_tiles)
+  return labels
+
+def segmentation_agreement(nd2_file, cell_channel, n_wells=8, well_inds=None, seed=0, engine='classical', engine_params=None,
+                           flow_threshold=0.9, cellprob_threshold=-5, diameter=None, model_type='nuclei', gpu=None,
+                           tile_size=None, tile_overlap=128, iou_threshold=0.5, plate_size=96):
+  # compare an engine against cellpose on a sample of wells, nothing is written to the result store.
+  reader = open_plate(nd2_file)
+  if well_inds is None:
+    rng = np.random.default_rng(seed)
+    well_inds = np.sort(rng.choice(reader.shape[0], size=min(n_wells, reader.shape[0]), replace=False))
+  if (engine == 'classical') and (tile_size is None):
+    tile_size = CLASSICAL_TILE_SIZE
+  reference_segment = segment_function(flow_threshold, cellprob_threshold, diameter, engine_model_params('cellpose', None, model_type, gpu))
+  threads = os.cpu_count() or 1
+  model_params = engine_model_params(engine, engine_params, model_type, gpu, threads)
+  rows = []
+  for well_ind in well_inds:
+    im = reader.read(well_ind, cell_channel)
+    start = time.perf_counter()
+    reference = reference_segment([im])[0]
+    reference_seconds = time.perf_counter()-start
+    start = time.perf_counter()
+    labels = segment_image(im, flow_threshold, cellprob_threshold, diameter, model_params, tile_size, tile_overlap, threads)
+    seconds = time.perf_counter()-start
+    rows.append({'well_ind': int(well_ind), **mask_agreement(labels, reference, iou_threshold),
+                 'seconds': seconds, 'cellpose_seconds': reference_seconds})
+  agreement = pd.DataFrame(rows)
+  agreement.insert(0, 'well', well_ind_to_id(agreement['well_ind'].to_numpy(), plate_size))
+  print(f"{engine} vs cellpose on {len(agreement)} wells: mean F1 {agreement['f1'].mean():.3f}, "
+        f"cell count ratio {agreement['cells'].sum()/max(agreement['reference_cells'].sum(), 1):.2f}, "
+        f"{agreement['cellpose_seconds'].sum()/max(agreement['seconds'].sum(), 1e-9):.1f}x faster")
+  return agreement
+
+def process_plate(nd2_file, meta_data, cell_channel, scaffold_channel, epi_channel, int_channels=None, threshold_factor=0.5,
+                  flow_threshold=0.9, cellprob_threshold=-5, diameter=None, tile_size=None, tile_overlap=128, model_type='nuclei', gpu=None,
+                  engine='cellpose', engine_params=None, background_tile_size=512, background_percentiles=(), redo=False, workers=1,
+                  memory_gb=None, plate_size=96, callbacks=None):
+  # fused run_cellpose, calculate_cell_features and calculate_scaffold_epi_ratios: every well's planes are read once
+  # and all of its results are written together.
+  result_file = nd2_file_2_zarr_result_file(nd2_file)
+  output = zarr.open(result_file)
+  reader = open_plate(nd2_file)
+  int_channels = list(int_channels) if int_channels is not None else [scaffold_channel, epi_channel]
+  if (engine == 'classical') and (tile_size is None):
+    tile_size = CLASSICAL_TILE_SIZE
+  segment_params = {'flow_threshold': flow_threshold, 'cellprob_threshold': cellprob_threshold, 'diameter': diameter,
+                    'tile_size': tile_size, 'tile_overlap': tile_overlap}
+  mask_fp = mask_fingerprint(nd2_file, cell_channel, model_type=model_type, engine=engine, engine_params=engine_params, **segment_params)
+  background_params = {'tile_size': background_tile_size, 'percentiles': list(background_percentiles)}
+  # wells whose mask and features are both current are only summarized from the stored intensities, wells with only a
+  # current mask reuse it instead of segmenting again.
+  current_masks = set() if redo else set(well_ind for well_ind in range(reader.shape[0])
+                                         if is_current(output, f'cells/masks/well {well_ind}/channel {cell_channel}', mask_fp))
+  well_inds = [well_ind for well_ind in range(reader.shape[0])
+               if redo or (well_ind not in current_masks)
+               or (not features_current(output, nd2_file, well_ind, cell_channel, int_channels, background_params))]
+  for group in ['cells/masks','cells/index','cells/features','cells/intensities','cells/background','cells/background_tiles']:
+    output.require_group(group)
+  n_planes = len(set([cell_channel]+int_channels))
+  well_nbytes = plane_nbytes(reader)*(n_planes+CELLPOSE_MEMORY_FACTOR)
+  threads = max(1, (os.cpu_count() or 1)//wells_in_flight(workers, memory_gb, well_nbytes))
+  model_params = engine_model_params(engine, engine_params, model_type, gpu, threads)
+  metrics = MetricsCollector()
+  results, timings = map_wells(process_well, well_inds,
+                               (nd2_file, cell_channel, int_channels, scaffold_channel, epi_channel, threshold_factor, segment_params,
+                                mask_fp, model_params, background_params, threads, current_masks),
+                               workers=workers, memory_gb=memory_gb, well_nbytes=well_nbytes, callbacks=default_callbacks(callbacks)+[metrics])
+  save_metrics(output, 'process', metrics)
+  if (len(well_inds) > 0) | (open_cell_table(result_file) is None):
+    invalidate_cell_table(result_file)
+    build_cell_table(result_file)
+  summaries = dict(zip(well_inds, results))
+  signal_data = [summaries[well_ind] if well_ind in summaries else well_signal(well_ind, result_file, scaffold_channel, epi_channel, threshold_factor)
+                 for well_ind in range(reader.shape[0])]
+  return ratio_table(signal_data, meta_data, plate_size)
+
+def process_well(well_ind, nd2_file, cell_channel, int_channels, scaffold_channel, epi_channel, threshold_factor, segment_params,
+                 mask_fp, model_params, background_params, batch_tiles=1, current_masks=()):
+  output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+  reader = open_plate(nd2_file)
+  mask_path = f'cells/masks/well {well_ind}/channel {cell_channel}'
+  # a current mask is read back, its run id and the features of other channels computed from it stay valid.
+  segment = well_ind not in current_masks
+  # every plane of the well in one read.
+  channels = list(dict.fromkeys(([cell_channel] if segment else [])+int_channels))
+  with stage('read'):
+    ims = reader.read(well_ind, channels)
+  int_ims = ims[[channels.index(int_channel) for int_channel in int_channels]]
+  if segment:
+    with stage('segment'):
+      mask_im = segment_image(ims[0], model_params=model_params, batch_tiles=batch_tiles, **segment_params)
+  else:
+    with stage('read_mask'):
+      mask_im = output[mask_path][:]
+  with stage('features'):
+    morphology, features, backgrounds = label_features(mask_im, int_ims, background_tile_size=background_params['tile_size'],
+                                                       background_percentiles=background_params['percentiles'])
+  # mask first, the feature fingerprints refer to its new run id.
+  with stage('write'):
+    if segment:
+      write_mask(output, well_ind, cell_channel, mask_im, mask_fp, segment_params.get('tile_size') or MASK_CHUNK_SIZE)
+    write_cell_features(output, nd2_file, well_ind, cell_channel, int_channels, background_params, morphology, features, backgrounds)
+  # summary at the stored float32 precision, so it matches calculate_scaffold_epi_ratios.
+  means = features[:,:,FEATURE_COLUMNS.index('mean')].astype(np.float32)
+  return signal_summary(well_ind, means[int_channels.index(scaffold_channel)], means[int_channels.index(epi_channel)],
+                        backgrounds[int_channels.index(scaffold_channel)][0].astype(np.float32), threshold_factor)
+
+def calculate_intensities_channel(nd2_file, cell_channel, int_channel, redo=False, workers=1, memory_gb=None, callbacks=None):
+  return calculate_cell_features(nd2_file, cell_channel, [int_channel], redo=redo, workers=workers, memory_gb=memory_gb,
+                                 callbacks=callbacks)
+
+def calculate_cell_features(nd2_file, cell_channel, int_channels, redo=False, workers=1, memory_gb=None,
+                            background_tile_size=512, background_percentiles=(), callbacks=None):
   # get result zarr file. 
   result_file = nd2_file_2_zarr_result_file(nd2_file)
   output = zarr.open(result_file)
   # read nd2 file.
-  im_data, channel_names, colormaps = read_nd2(nd2_file)
-  # get intensity channel index.
-  channel_ind = channel_names.index(int_channel)
-  for well_ind in tqdm(range(im_data.shape[0]), desc='Processing well'):
-    # check if data is already present, unless redo is requested.
-    int_path = Path(f'cells/intensities/well {well_ind}/channel {int_channel}')
-    if (int_path not in output) | redo==True:
-      # remove previous data if present.
-      if (int_path in output) & redo==True: 
-          shutil.rmtree(result_file/int_path)
-      # get mask.
-      mask_im = output[f'cells/masks/well {well_ind}/channel {cell_channel}'][:]
-      # get image.
-      int_im = im_data[well_ind,channel_ind,:,:].to_numpy()
-      # get region intensities.
-      props = regionprops(mask_im, int_im)
-      values = np.array([region["mean_intensity"] for region in props])
-      # store.
-      well_group = output.require_group(int_path.parents[0])
-      array = well_group.require_dataset(int_path.name,data=values,shape = values.shape,chunks=(50000,), dtype='f')
-      # Background values.
-      bg_path = Path(f'cells/background/well {well_ind}/channel {int_channel}/')
-      if (bg_path in output) & redo==True: shutil.rmtree(result_file/bg_path)
-      bg_pixs = int_im[mask_im==0]
-      values = np.array([bg_pixs.mean(),bg_pixs.std()])
-      well_group = output.require_group(bg_path.parents[0])
-      array = well_group.require_dataset(bg_path.name,data=values,shape = values.shape,chunks=(10,), dtype='f')
-
-def calculate_scaffold_epi_ratios(nd2_file, meta_data, scaffold_channel, epi_channel, threshold_factor = 0.5):
+  reader = open_plate(nd2_file)
+  background_params = {'tile_size': background_tile_size, 'percentiles': list(background_percentiles)}
+  # only recompute wells whose mask or inputs changed, unless redo is requested.
+  well_inds = [well_ind for well_ind in range(reader.shape[0])
+               if (redo==True) | (not features_current(output, nd2_file, well_ind, cell_channel, int_channels, background_params))]
+  # create shared groups up front so workers only write their own well group.
+  for group in ['cells/features','cells/intensities','cells/background','cells/background_tiles']:
+    output.require_group(group)
+  well_nbytes = plane_nbytes(reader)*(len(int_channels)+FEATURES_MEMORY_FACTOR)
+  metrics = MetricsCollector()
+  results, timings = map_wells(cell_features_well, well_inds, (nd2_file, cell_channel, int_channels, background_params),
+                               workers=workers, memory_gb=memory_gb, well_nbytes=well_nbytes, callbacks=default_callbacks(callbacks)+[metrics])
+  save_metrics(output, 'features', metrics)
+  # rebuild the consolidated plate table when any well changed.
+  if (len(well_inds) > 0) | (open_cell_table(result_file) is None):
+    invalidate_cell_table(result_file)
+    build_cell_table(result_file)
+  return timings
+
+def cell_features_well(well_ind, nd2_file, cell_channel, int_channels, background_params):
+  output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+  reader = open_plate(nd2_file)
+  # get mask.
+  with stage('read_mask'):
+    mask_im = output[f'cells/masks/well {well_ind}/channel {cell_channel}'][:]
+  # get all channel images in one read.
+  with stage('read'):
+    int_ims = reader.read(well_ind, int_channels)
+  # get per cell features and the robust global and per tile background in a single pass.
+  with stage('features'):
+    morphology, features, backgrounds = label_features(mask_im, int_ims, background_tile_size=background_params['tile_size'],
+                                                       background_percentiles=background_params['percentiles'])
+  # store.
+  with stage('write'):
+    write_cell_features(output, nd2_file, well_ind, cell_channel, int_channels, background_params, morphology, features, backgrounds)
+
+def write_cell_features(output, nd2_file, well_ind, cell_channel, int_channels, background_params, morphology, features, backgrounds):
+  fps = feature_fingerprints(output, nd2_file, well_ind, cell_channel, int_channels, background_params)
+  stamp(write_array(output, Path(f'cells/features/well {well_ind}/morphology'), morphology, MORPHOLOGY_COLUMNS), fps[None])
+  background_columns = percentile_columns(background_params['percentiles'])
+  for int_channel, channel_features, (background, tile_background) in zip(int_channels, features, backgrounds):
+    stamp(write_array(output, Path(f'cells/features/well {well_ind}/channel {int_channel}'), channel_features, FEATURE_COLUMNS), fps[int_channel])
+    stamp(write_array(output, Path(f'cells/intensities/well {well_ind}/channel {int_channel}'), channel_features[:,FEATURE_COLUMNS.index('mean')]), fps[int_channel])
+    stamp(write_array(output, Path(f'cells/background/well {well_ind}/channel {int_channel}'), background, background_columns, chunks=background.shape), fps[int_channel])
+    if tile_background is not None:
+      tiles = write_array(output, Path(f'cells/background_tiles/well {well_ind}/channel {int_channel}'), tile_background, background_columns, chunks=tile_background.shape)
+      tiles.attrs['tile_size'] = background_params['tile_size']
+      stamp(tiles, fps[int_channel])
+
+def features_current(output, nd2_file, well_ind, cell_channel, int_channels, background_params):
+  fps = feature_fingerprints(output, nd2_file, well_ind, cell_channel, int_channels, background_params)
+  return all(is_current(output, f'cells/features/well {well_ind}/channel {int_channel}', fps[int_channel]) for int_channel in int_channels)
+
+def feature_fingerprints(output, nd2_file, well_ind, cell_channel, int_channels, background_params):
+  # features depend on the exact mask they were computed from.
+  mask_run = run_id(output, f'cells/masks/well {well_ind}/channel {cell_channel}')
+  fps = {int_channel: fingerprint(nd2_file, 'features', STAGE_VERSIONS['features'], channel=int_channel, mask=mask_run,
+                                  background=background_params)
+         for int_channel in int_channels}
+  fps[None] = fingerprint(nd2_file, 'features', STAGE_VERSIONS['features'], channel=None, mask=mask_run)
+  return fps
+
+# bump when a stage's algorithm changes so stored results are recomputed.
+STAGE_VERSIONS = {'masks': 1, 'features': 2}
+
+# rough peak memory per well in multiples of one raw image plane.
+CELLPOSE_MEMORY_FACTOR = 16
+FEATURES_MEMORY_FACTOR = 2
+
+def plane_nbytes(reader):
+  return reader.shape[-2]*reader.shape[-1]*reader.dtype.itemsize
+
+MORPHOLOGY_COLUMNS = ['label', 'area', 'centroid_y', 'centroid_x']
+INDEX_COLUMNS = MORPHOLOGY_COLUMNS+['y0', 'x0', 'y1', 'x1']
+# square mask chunks, a cell crop touches at most a few of them.
+MASK_CHUNK_SIZE = 1024
+COMPRESSOR = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+FEATURE_COLUMNS = ['sum', 'mean', 'std', 'min', 'max']
+
+def label_features(mask_im, int_ims, strip_rows=1024, background_tile_size=None, background_percentiles=()):
+  # accumulate per label moments and the background histograms strip by strip, so temporaries stay small and the
+  # pixels are visited once. with background tiles, strips are one tile high.
+  if background_tile_size is not None:
+    strip_rows = background_tile_size
+  n_labels = int(mask_im.max())+1
+  n_channels = int_ims.shape[0]
+  width = mask_im.shape[1]
+  area = np.zeros(n_labels)
+  sum_y = np.zeros(n_labels)
+  sum_x = np.zeros(n_labels)
+  sums = np.zeros((n_channels,n_labels))
+  sums_sq = np.zeros((n_channels,n_labels))
+  mins = np.full((n_channels,n_labels), np.inf)
+  maxs = np.full((n_channels,n_labels), -np.inf)
+  background_hists = np.zeros((n_channels,N_LEVELS), np.int64)
+  tile_stats = [[] if background_tile_size is not None else None for _ in range(n_channels)]
+  for y_start in range(0, mask_im.shape[0], strip_rows):
+    mask_strip = mask_im[y_start:y_start+strip_rows,:]
+    labels = mask_strip.ravel().astype(np.intp)
+    rows, cols = np.divmod(np.arange(labels.size), width)
+    area += np.bincount(labels, minlength=n_labels)
+    sum_y += np.bincount(labels, weights=rows+y_start, minlength=n_labels)
+    sum_x += np.bincount(labels, weights=cols, minlength=n_labels)
+    # sort once per strip so min/max reduce over contiguous label runs.
+    order = np.argsort(labels, kind='stable')
+    starts = np.flatnonzero(np.diff(labels[order], prepend=-1))
+    present = labels[order][starts]
+    for channel in range(n_channels):
+      image_strip = int_ims[channel,y_start:y_start+strip_rows,:]
+      strip_hist, row_stats = strip_background(mask_strip, image_strip, background_tile_size, background_percentiles)
+      background_hists[channel] += strip_hist
+      if row_stats is not None:
+        tile_stats[channel].append(row_stats)
+      values = image_strip.ravel()
+      weights = values.astype(np.float64)
+      sums[channel] += np.bincount(labels, weights=weights, minlength=n_labels)
+      sums_sq[channel] += np.bincount(labels, weights=weights*weights, minlength=n_labels)
+      sorted_values = values[order]
+      mins[channel,present] = np.minimum(mins[channel,present], np.minimum.reduceat(sorted_values, starts))
+      maxs[channel,present] = np.maximum(maxs[channel,present], np.maximum.reduceat(sorted_values, starts))
+  # moments to statistics (label 0 is background).
+  with np.errstate(invalid='ignore', divide='ignore'):
+    means = sums/area
+    stds = np.sqrt(np.maximum(sums_sq/area - means**2, 0))
+    centroid_y = sum_y/area
+    centroid_x = sum_x/area
+  # keep labels that are present, like regionprops.
+  cells = np.flatnonzero(area[1:])+1
+  morphology = np.stack([cells, area[cells], centroid_y[cells], centroid_x[cells]], axis=1)
+  features = np.stack([sums[:,cells], means[:,cells], stds[:,cells], mins[:,cells], maxs[:,cells]], axis=2)
+  # robust global and per tile background of every channel, as background_stats computes it.
+  backgrounds = [background_result(hist, tiles, background_percentiles) for hist, tiles in zip(background_hists, tile_stats)]
+  return morphology, features, backgrounds
+
+def cell_index(mask, n_labels=None, strip_rows=1024):
+  # bounding box (y1/x1 exclusive), centroid and area per label, strip by strip so zarr masks (with n_labels given) are read a chunk row at a time.
+  if n_labels is None:
+    n_labels = int(mask.max())+1
+  width = mask.shape[1]
+  area = np.zeros(n_labels)
+  sum_y = np.zeros(n_labels)
+  sum_x = np.zeros(n_labels)
+  bounds = np.stack([np.full(n_labels, np.inf), np.full(n_labels, np.inf), np.full(n_labels, -np.inf), np.full(n_labels, -np.inf)])
+  for y_start in range(0, mask.shape[0], strip_rows):
+    labels = np.asarray(mask[y_start:y_start+strip_rows,:]).ravel().astype(np.intp)
+    rows, cols = np.divmod(np.arange(labels.size), width)
+    rows += y_start
+    area += np.bincount(labels, minlength=n_labels)
+    sum_y += np.bincount(labels, weights=rows, minlength=n_labels)
+    sum_x += np.bincount(labels, weights=cols, minlength=n_labels)
+    order = np.argsort(labels, kind='stable')
+    starts = np.flatnonzero(np.diff(labels[order], prepend=-1))
+    present = labels[order][starts]
+    for i, (values, reduce) in enumerate([(rows, np.minimum), (cols, np.minimum), (rows+1, np.maximum), (cols+1, np.maximum)]):
+      bounds[i,present] = reduce(bounds[i,present], reduce.reduceat(values[order], starts))
+  cells = np.flatnonzero(area[1:])+1
+  with np.errstate(invalid='ignore', divide='ignore'):
+    centroids = np.stack([sum_y[cells]/area[cells], sum_x[cells]/area[cells]], axis=1)
+  return np.column_stack([cells, area[cells], centroids, bounds[:,cells].T])
+
+def write_array(output, array_path, values, columns=None, chunks=None, dtype='f', compressor='default'):
+  # replace any previous data.
+  if chunks is None:
+    chunks = (50000,)+values.shape[1:]
+  well_group = output.require_group(array_path.parents[0].as_posix())
+  array = well_group.create_dataset(array_path.name, data=values, shape=values.shape, chunks=chunks, dtype=dtype, compressor=compressor,
+                                    overwrite=True)
+  if columns is not None:
+    array.attrs['columns'] = columns
+  return array
+
+def calculate_scaffold_epi_ratios(nd2_file, meta_data, scaffold_channel, epi_channel, threshold_factor = 0.5, workers=1,
+                                  local_background=False, plate_size=96, callbacks=None):
   # get result zarr file. 
   result_file = nd2_file_2_zarr_result_file(nd2_file)
-  proc_data = zarr.open(result_file)
-  signal_data = []
-  for well_ind in tqdm(range(96),desc='Analyzing wells'):
-    # get scaffold intensities
-    scaffold_intensities = proc_data[f'cells/intensities/well {well_ind}/channel {scaffold_channel}'][:]
-    # get background values.
-    background_values = proc_data[f'cells/background/well {well_ind}/channel {scaffold_channel}'][:]
-    mean_background = background_values[0]
-    std_background = background_values[1]
-    # THRESHOLD.
-    threshold = mean_background+(threshold_factor*std_background)
-    sig_cells = np.argwhere(scaffold_intensities>threshold)
-    # get epi intensities.  
-    epi_intensities = proc_data[f'cells/intensities/well {well_ind}/channel {epi_channel}'][:]
-    # store info
-    signal_data.append({'well':well_ind_to_id(well_ind),'num_cells': scaffold_intensities.shape[0],
-                        'num_sig_cells':sig_cells.size,'scaffold_signal':scaffold_intensities[sig_cells].mean(),'epi_signal':epi_intensities[sig_cells].mean()})
+  table = open_cell_table(result_file)
+  if (table is None) & local_background:
+    build_cell_table(result_file)
+    table = open_cell_table(result_file)
+  if table is not None:
+    # whole plate in a few reads from the consolidated table.
+    offsets = table['offsets'][:]
+    scaffold_intensities = table[f'columns/{scaffold_channel} mean'][:]
+    epi_intensities = table[f'columns/{epi_channel} mean'][:]
+    background_values = table[f'background/{scaffold_channel}'][:]
+    if local_background:
+      # threshold every cell against the background of its own tile.
+      background_values = local_cell_background(result_file, scaffold_channel, table=table)
+      background_values = [background_values[offsets[well_ind]:offsets[well_ind+1]] for well_ind in range(offsets.size-1)]
+    signal_data = [signal_summary(well_ind, scaffold_intensities[offsets[well_ind]:offsets[well_ind+1]],
+                                  epi_intensities[offsets[well_ind]:offsets[well_ind+1]], background_values[well_ind], threshold_factor)
+                   for well_ind in range(offsets.size-1)]
+  else:
+    n_wells = len(list(zarr.open(result_file)['cells/intensities'].group_keys()))
+    signal_data, timings = map_wells(well_signal, range(n_wells), (result_file, scaffold_channel, epi_channel, threshold_factor),
+                                     workers=workers, desc='Analyzing wells', callbacks=callbacks)
+  return ratio_table(signal_data, meta_data, plate_size)
+
+def ratio_table(signal_data, meta_data, plate_size=96):
   # calculate ratios.
   signal_data = pd.DataFrame(signal_data)
+  signal_data.insert(0, 'well', well_ind_to_id(signal_data.pop('well_ind').to_numpy(), plate_size))
   signal_data['ratio'] =  signal_data['epi_signal']/signal_data['scaffold_signal']
   signal_data['perc_pos'] =  (signal_data['num_sig_cells']/signal_data['num_cells'])*100
   signal_data = meta_data.merge(signal_data,on='well')
   # set types.
   signal_data = signal_data.astype({'num_cells': 'int32','num_sig_cells': 'int32'})
   return signal_data
+
+def well_signal(well_ind, result_file, scaffold_channel, epi_channel, threshold_factor):
+  proc_data = zarr.open(result_file)
+  # get scaffold intensities
+  scaffold_intensities = proc_data[f'cells/intensities/well {well_ind}/channel {scaffold_channel}'][:]
+  # get background values.
+  background_values = proc_data[f'cells/background/well {well_ind}/channel {scaffold_channel}'][:]
+  # get epi intensities.  
+  epi_intensities = proc_data[f'cells/intensities/well {well_ind}/channel {epi_channel}'][:]
+  return signal_summary(well_ind, scaffold_intensities, epi_intensities, background_values, threshold_factor)
+
+def signal_summary(well_ind, scaffold_intensities, epi_intensities, background_values, threshold_factor):
+  # background is either one row for the well or one row per cell.
+  mean_background = background_values[...,0]
+  std_background = background_values[...,1]
+  # THRESHOLD.
+  threshold = mean_background+(threshold_factor*std_background)
+  sig_cells = np.argwhere(scaffold_intensities>threshold)
+  # store info
+  return {'well_ind':well_ind,'num_cells': scaffold_intensities.shape[0],
+          'num_sig_cells':sig_cells.size,'scaffold_signal':scaffold_intensities[sig_cells].mean(),'epi_signal':epi_intensities[sig_cells].mean()}
+
+def sweep_scaffold_epi_ratios(nd2_file, meta_data, scaffold_channel, epi_channel, threshold_factors, local_background=False,
+                              plate_size=96):
+  # get plate table.
+  result_file = nd2_file_2_zarr_result_file(nd2_file)
+  table = open_cell_table(result_file)
+  if table is None:
+    build_cell_table(result_file)
+    table = open_cell_table(result_file)
+  if table is None:
+    raise ValueError(f'No cell features stored for {nd2_file}, run calculate_cell_features first')
+  offsets = table['offsets'][:]
+  scaffold_intensities = table[f'columns/{scaffold_channel} mean'][:]
+  epi_intensities = table[f'columns/{epi_channel} mean'][:]
+  background_values = table[f'background/{scaffold_channel}'][:]
+  if local_background:
+    cell_background = local_cell_background(result_file, scaffold_channel, table=table)
+  threshold_factors = np.asarray(threshold_factors, dtype=np.float64)
+  signal_data = []
+  for well_ind in range(offsets.size-1):
+    scaffold = scaffold_intensities[offsets[well_ind]:offsets[well_ind+1]]
+    epi = epi_intensities[offsets[well_ind]:offsets[well_ind+1]]
+    if local_background:
+      # with per cell backgrounds, sort on the background z-score so a factor is still a single cut.
+      well_background = cell_background[offsets[well_ind]:offsets[well_ind+1]]
+      sort_key = (scaffold-well_background[:,0])/well_background[:,1]
+      thresholds = threshold_factors
+    else:
+      sort_key = scaffold
+      thresholds = background_values[well_ind,0]+(threshold_factors*background_values[well_ind,1])
+    # sort once, then every threshold is a binary search into cumulative sums.
+    order = np.argsort(sort_key, kind='stable')
+    scaffold_cumsum = np.concatenate([[0], np.cumsum(scaffold[order], dtype=np.float64)])
+    epi_cumsum = np.concatenate([[0], np.cumsum(epi[order], dtype=np.float64)])
+    # THRESHOLD.
+    first_sig = np.searchsorted(sort_key[order], thresholds, side='right')
+    num_sig_cells = scaffold.size-first_sig
+    with np.errstate(invalid='ignore', divide='ignore'):
+      scaffold_signal = (scaffold_cumsum[-1]-scaffold_cumsum[first_sig])/num_sig_cells
+      epi_signal = (epi_cumsum[-1]-epi_cumsum[first_sig])/num_sig_cells
+    signal_data.append(pd.DataFrame({'well_ind':well_ind, 'threshold_factor':threshold_factors,
+                                     'num_cells':scaffold.size, 'num_sig_cells':num_sig_cells,
+                                     'scaffold_signal':scaffold_signal, 'epi_signal':epi_signal}))
+  return ratio_table(pd.concat(signal_data, ignore_index=True), meta_data, plate_size)
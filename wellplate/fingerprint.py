@@ -0,0 +1,38 @@
+import os
+import json
+import uuid
+import hashlib
+from pathlib import Path
+from importlib.metadata import version, PackageNotFoundError
+
+
+def code_version():
+    try:
+        return version('wellplate')
+    except PackageNotFoundError:
+        return 'unknown'
+
+def file_identity(file_loc):
+    stat = os.stat(file_loc)
+    return {'name': Path(file_loc).name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def fingerprint(nd2_file, stage, stage_version, **params):
+    # hash of everything an artifact depends on.
+    inputs = {'nd2': file_identity(nd2_file), 'stage': stage, 'stage_version': stage_version,
+              'code_version': code_version(), 'params': params}
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def is_current(output, array_path, expected):
+    array_path = Path(array_path).as_posix()
+    return (array_path in output) and (output[array_path].attrs.get('fingerprint') == expected)
+
+def stamp(array, fingerprint):
+    # run_id changes on every write, so downstream artifacts that record it go stale when this one is regenerated.
+    array.attrs.update({'fingerprint': fingerprint, 'run_id': uuid.uuid4().hex})
+    return array
+
+def run_id(output, array_path):
+    array_path = Path(array_path).as_posix()
+    if array_path not in output:
+        return None
+    return output[array_path].attrs.get('run_id')
@@ -0,0 +1,55 @@
+import string
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# (rows, columns) of standard plate formats.
+PLATE_SHAPES = {6: (2, 3), 12: (3, 4), 24: (4, 6), 48: (6, 8), 96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+def row_names(n_rows):
+    # A..Z, then AA, AB, ... as used on 1536 well plates.
+    letters = list(string.ascii_uppercase)
+    names = letters + [a+b for a in letters for b in letters]
+    return names[:n_rows]
+
+class PlateGeometry():
+    # precomputed index <-> ID <-> (row, col) tables for one plate format.
+    def __init__(self, plate_size=96):
+        if plate_size not in PLATE_SHAPES:
+            raise ValueError(f'Unsupported plate size {plate_size}, expected one of {list(PLATE_SHAPES)}')
+        self.plate_size = plate_size
+        self.shape = PLATE_SHAPES[plate_size]
+        self.n_rows, self.n_cols = self.shape
+        self.inds = np.arange(plate_size)
+        self.rows, self.cols = np.divmod(self.inds, self.n_cols)
+        self.row_names = np.array(row_names(self.n_rows))
+        self.ids = np.char.add(self.row_names[self.rows], (self.cols+1).astype(str))
+        self.id_index = pd.Index(self.ids)
+    def ind_to_id(self, inds):
+        ids = self.ids[inds]
+        if np.ndim(ids) == 0:
+            return str(ids)
+        return ids
+    def id_to_ind(self, ids):
+        inds = self.id_index.get_indexer(np.atleast_1d(ids))
+        if np.any(inds < 0):
+            raise KeyError(f'Unknown well IDs {np.atleast_1d(ids)[inds < 0]}')
+        if np.ndim(ids) == 0:
+            return int(inds[0])
+        return inds
+    def ind_to_row_col(self, inds):
+        return self.rows[inds], self.cols[inds]
+    def row_col_to_ind(self, rows, cols):
+        return np.asarray(rows)*self.n_cols+np.asarray(cols)
+    def neighbors(self, ind):
+        # wells adjacent on the plate, including diagonals.
+        row, col = self.rows[ind], self.cols[ind]
+        d_rows, d_cols = np.meshgrid([-1, 0, 1], [-1, 0, 1], indexing='ij')
+        rows, cols = row+d_rows.ravel(), col+d_cols.ravel()
+        valid = (rows >= 0) & (rows < self.n_rows) & (cols >= 0) & (cols < self.n_cols) & ~((rows == row) & (cols == col))
+        return [int(ind) for ind in self.row_col_to_ind(rows[valid], cols[valid])]
+
+@lru_cache(maxsize=None)
+def plate_geometry(plate_size=96):
+    return PlateGeometry(plate_size)
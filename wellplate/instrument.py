@@ -0,0 +1,171 @@
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import zarr
+from tqdm.auto import tqdm
+try:
+    import resource
+except ImportError:
+    resource = None
+
+METRICS_PATH = 'metrics'
+METRIC_COLUMNS = ['well_ind', 'stage', 'wall_seconds', 'cpu_seconds', 'bytes_read', 'bytes_written', 'peak_rss_mb']
+
+# spans of the well being processed in this process, None when nothing is recorded.
+_spans = None
+
+
+def io_counters():
+    # bytes passed through read/write calls of this process (page cache hits included), zeros where unavailable.
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss_mb():
+    # high water mark of the process, so it never decreases between stages.
+    # VmHWM is preferred since ru_maxrss of a spawned worker can include the parent's peak from before exec.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/2**10
+    except OSError:
+        pass
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+@contextmanager
+def stage(name):
+    # time one stage of a well function, a no-op unless the caller is recording. stages should not be nested.
+    if _spans is None:
+        yield
+        return
+    wall, cpu, (read, written) = time.perf_counter(), time.process_time(), io_counters()
+    try:
+        yield
+    finally:
+        end_read, end_written = io_counters()
+        _spans.append({'stage': name, 'wall_seconds': time.perf_counter()-wall, 'cpu_seconds': time.process_time()-cpu,
+                       'bytes_read': end_read-read, 'bytes_written': end_written-written, 'peak_rss_mb': peak_rss_mb()})
+
+@contextmanager
+def recording():
+    # collect the stages run inside the block, plus a 'total' span covering all of it.
+    global _spans
+    spans = []
+    _spans = spans
+    try:
+        with stage('total'):
+            yield spans
+    finally:
+        _spans = None
+
+class Callback():
+    # hooks called by map_wells, subclasses override what they need. records=True asks workers for stage spans.
+    records = False
+    def start(self, total, desc):
+        pass
+    def well_done(self, well_ind, seconds, spans):
+        pass
+    def finish(self, total_seconds, workers):
+        pass
+
+class TqdmProgress(Callback):
+    # progress bar that renders as a widget in Jupyter and as text in a terminal.
+    def start(self, total, desc):
+        self.total = total
+        self.bar = tqdm(total=total, desc=desc)
+    def well_done(self, well_ind, seconds, spans):
+        self.bar.update()
+    def finish(self, total_seconds, workers):
+        self.bar.close()
+        print_summary(self.total, total_seconds, workers)
+
+class PrintProgress(Callback):
+    # one line every `every` wells, for logs of unattended runs.
+    def __init__(self, every=10, log=print):
+        self.every = every
+        self.log = log
+    def start(self, total, desc):
+        self.total, self.desc, self.done = total, desc, 0
+        self.started = time.perf_counter()
+    def well_done(self, well_ind, seconds, spans):
+        self.done += 1
+        if (self.done % self.every == 0) or (self.done == self.total):
+            elapsed = time.perf_counter()-self.started
+            self.log(f'{self.desc}: {self.done}/{self.total} wells, {elapsed:.1f} s elapsed, last well {seconds:.1f} s')
+    def finish(self, total_seconds, workers):
+        print_summary(self.total, total_seconds, workers, self.log)
+
+class MetricsCollector(Callback):
+    # gathers the per well stage spans of one map_wells call.
+    records = True
+    def __init__(self):
+        self.rows = []
+        self.workers = 1
+        self.total_seconds = 0.0
+    def well_done(self, well_ind, seconds, spans):
+        self.rows.extend(dict(span, well_ind=well_ind) for span in spans)
+    def finish(self, total_seconds, workers):
+        self.total_seconds = total_seconds
+        self.workers = workers
+    def table(self):
+        return pd.DataFrame(self.rows, columns=METRIC_COLUMNS)
+
+def print_summary(n_wells, total_seconds, workers, log=print):
+    if n_wells > 0:
+        log(f"Processed {n_wells} wells in {total_seconds:.1f} s with {workers} worker(s) "
+            f"({n_wells/(total_seconds/60):.1f} wells/minute)")
+
+def default_callbacks(callbacks=None):
+    # None shows a progress bar, an empty list runs silently.
+    if callbacks is None:
+        return [TqdmProgress()]
+    return list(callbacks)
+
+def save_metrics(output, step, collector):
+    # latest run of a step, stage names are stored once and referenced by index.
+    metrics = collector.table()
+    if len(metrics) == 0:
+        return None
+    stages = list(dict.fromkeys(metrics['stage']))
+    values = metrics.assign(stage=metrics['stage'].map(stages.index)).to_numpy(dtype=np.float64)
+    array = output.require_group(METRICS_PATH).create_dataset(step, data=values, chunks=values.shape, overwrite=True)
+    array.attrs.update({'columns': METRIC_COLUMNS, 'stages': stages, 'workers': collector.workers,
+                        'total_seconds': collector.total_seconds, 'timestamp': time.time()})
+    return array
+
+def read_metrics(result_file, step=None):
+    output = zarr.open(result_file, mode='r')
+    if METRICS_PATH not in output:
+        return pd.DataFrame(columns=['step']+METRIC_COLUMNS)
+    steps = [step] if step is not None else sorted(output[METRICS_PATH].array_keys())
+    tables = []
+    for name in steps:
+        array = output[f'{METRICS_PATH}/{name}']
+        table = pd.DataFrame(array[:], columns=array.attrs['columns'])
+        table['stage'] = np.array(array.attrs['stages'])[table['stage'].astype(int)]
+        table['well_ind'] = table['well_ind'].astype(int)
+        table.insert(0, 'step', name)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+def metrics_report(result_file, step=None):
+    # where the time went: totals per step and stage, with each stage's share of the well time.
+    metrics = read_metrics(result_file, step)
+    report = metrics.groupby(['step', 'stage'], sort=False).agg(
+        wells=('well_ind', 'nunique'), wall_seconds=('wall_seconds', 'sum'), cpu_seconds=('cpu_seconds', 'sum'),
+        mb_read=('bytes_read', lambda values: values.sum()/2**20), mb_written=('bytes_written', lambda values: values.sum()/2**20),
+        peak_rss_mb=('peak_rss_mb', 'max')).reset_index()
+    report['seconds_per_well'] = report['wall_seconds']/report['wells']
+    report['cpu_utilization'] = report['cpu_seconds']/report['wall_seconds']
+    totals = report[report['stage'] == 'total'].set_index('step')['wall_seconds']
+    report['share'] = report['wall_seconds']/report['step'].map(totals)
+    return report
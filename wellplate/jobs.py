@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import sqlite3
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import zarr
+from wellplate.elements import read_plate_xml, read_plate_csv
+from wellplate.reader import open_plate
+from wellplate.geometry import plate_geometry
+from wellplate.extract import (nd2_file_2_zarr_result_file, cellpose_well, cell_features_well, mask_fingerprint, engine_model_params,
+                               features_current, is_current, build_cell_table, invalidate_cell_table,
+                               calculate_scaffold_epi_ratios)
+
+STAGES = ['segment', 'features', 'ratios']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS plates (
+    name TEXT PRIMARY KEY, nd2 TEXT NOT NULL, metadata TEXT, params TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY, plate TEXT NOT NULL, well INTEGER NOT NULL, stage TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, error TEXT,
+    seconds REAL, updated REAL, UNIQUE (plate, well, stage));
+'''
+
+
+class JobQueue():
+    # local on-disk queue of plate x well x stage jobs, every state change is committed immediately.
+    def __init__(self, db_file, max_attempts=2):
+        self.db_file = Path(db_file)
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(str(self.db_file))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+    def add_plate(self, name, nd2_file, metadata_file, params):
+        n_wells = open_plate(nd2_file).shape[0]
+        # create shared groups up front so workers only write their own well group.
+        output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+        for group in ['cells/masks', 'cells/index', 'cells/features', 'cells/intensities', 'cells/background', 'cells/background_tiles']:
+            output.require_group(group)
+        plate = (str(nd2_file), None if metadata_file is None else str(metadata_file), json.loads(json.dumps(params)))
+        with self.db:
+            previous = self.db.execute('SELECT nd2, metadata, params FROM plates WHERE name=?', (name,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO plates VALUES (?, ?, ?, ?)', (name, plate[0], plate[1], json.dumps(params)))
+            rows = [(name, well, stage) for stage in ['segment', 'features'] for well in range(n_wells)]
+            rows.append((name, -1, 'ratios'))
+            self.db.executemany('INSERT OR IGNORE INTO jobs (plate, well, stage) VALUES (?, ?, ?)', rows)
+            if (previous is not None) and ((previous['nd2'], previous['metadata'], json.loads(previous['params'])) != plate):
+                # changed inputs: every job of the plate runs again, run_job skips wells whose results are still current.
+                self.db.execute("UPDATE jobs SET status='pending', attempts=0, error=NULL WHERE plate=?", (name,))
+        return n_wells
+    def recover(self):
+        # jobs that were running when the previous run died are started again.
+        with self.db:
+            return self.db.execute("UPDATE jobs SET status='pending' WHERE status='running'").rowcount
+    def retry_failed(self):
+        with self.db:
+            return self.db.execute("UPDATE jobs SET status='pending', attempts=0, error=NULL WHERE status='failed'").rowcount
+    def fail_blocked(self):
+        # pending jobs whose dependency failed for good can never run, they fail with the reason. features first, so a
+        # plate's ratios job fails in the same call once none of its wells is left to run.
+        blocked = []
+        for query in ["""SELECT j.id, j.plate, j.well, j.stage, 'segment failed' AS error FROM jobs j WHERE j.stage='features'
+                AND j.status='pending' AND EXISTS (
+                SELECT 1 FROM jobs s WHERE s.plate=j.plate AND s.well=j.well AND s.stage='segment' AND s.status='failed')""",
+                      """SELECT j.id, j.plate, j.well, j.stage, 'failed wells: '||GROUP_CONCAT(DISTINCT f.well) AS error FROM jobs j
+                JOIN jobs f ON f.plate=j.plate AND f.stage IN ('segment', 'features') AND f.status='failed'
+                WHERE j.stage='ratios' AND j.status='pending' AND NOT EXISTS (
+                SELECT 1 FROM jobs w WHERE w.plate=j.plate AND w.stage IN ('segment', 'features') AND w.status IN ('pending', 'running'))
+                GROUP BY j.id"""]:
+            jobs = [dict(row) for row in self.db.execute(query)]
+            with self.db:
+                self.db.executemany("UPDATE jobs SET status='failed', error=?, updated=? WHERE id=?",
+                                    [(job['error'], time.time(), job['id']) for job in jobs])
+            blocked += jobs
+        return blocked
+    def claim(self, stage, limit):
+        # pending jobs of a stage whose dependencies are done.
+        if limit <= 0:
+            return []
+        if stage == 'segment':
+            query = "SELECT * FROM jobs j WHERE stage='segment' AND status='pending' ORDER BY id LIMIT ?"
+        elif stage == 'features':
+            query = '''SELECT * FROM jobs j WHERE stage='features' AND status='pending' AND EXISTS (
+                SELECT 1 FROM jobs s WHERE s.plate=j.plate AND s.well=j.well AND s.stage='segment' AND s.status='done')
+                ORDER BY id LIMIT ?'''
+        else:
+            query = '''SELECT * FROM jobs j WHERE stage='ratios' AND status='pending' AND NOT EXISTS (
+                SELECT 1 FROM jobs f WHERE f.plate=j.plate AND f.stage='features' AND f.status!='done')
+                ORDER BY id LIMIT ?'''
+        with self.db:
+            jobs = [dict(row) for row in self.db.execute(query, (limit,))]
+            self.db.executemany("UPDATE jobs SET status='running', attempts=attempts+1, updated=? WHERE id=?",
+                                [(time.time(), job['id']) for job in jobs])
+        return jobs
+    def finish(self, job, seconds):
+        with self.db:
+            self.db.execute("UPDATE jobs SET status='done', error=NULL, seconds=?, updated=? WHERE id=?",
+                            (seconds, time.time(), job['id']))
+    def fail(self, job, error):
+        attempts = self.db.execute('SELECT attempts FROM jobs WHERE id=?', (job['id'],)).fetchone()[0]
+        status = 'pending' if attempts < self.max_attempts else 'failed'
+        with self.db:
+            self.db.execute('UPDATE jobs SET status=?, error=?, updated=? WHERE id=?', (status, error, time.time(), job['id']))
+    def plate(self, name):
+        row = dict(self.db.execute('SELECT * FROM plates WHERE name=?', (name,)).fetchone())
+        row['params'] = json.loads(row['params'])
+        return row
+    def status(self):
+        return pd.read_sql_query('''SELECT plate, stage, status, COUNT(*) AS jobs, SUM(seconds) AS seconds
+            FROM jobs GROUP BY plate, stage, status ORDER BY plate, stage, status''', self.db)
+
+def run_job(stage, plate, well):
+    start = time.perf_counter()
+    params = plate['params']
+    nd2_file = plate['nd2']
+    output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+    if stage == 'segment':
+        segment = params['segment']
+        mask_fp = mask_fingerprint(nd2_file, params['cell_channel'], **segment)
+        engine = segment.get('engine', 'cellpose')
+        model_params = engine_model_params(engine, segment.get('engine_params'), segment.get('model_type', 'nuclei'), params.get('gpu'))
+        # the classical engine segments the tiles of a well in parallel threads.
+        batch_tiles = (os.cpu_count() or 1) if engine == 'classical' else 1
+        # results from an interrupted earlier run are reused when their inputs match.
+        if not is_current(output, f"cells/masks/well {well}/channel {params['cell_channel']}", mask_fp):
+            cellpose_well(well, nd2_file, params['cell_channel'], segment['flow_threshold'], segment['cellprob_threshold'],
+                          segment['diameter'], segment['tile_size'], segment['tile_overlap'], mask_fp, model_params, batch_tiles)
+    elif stage == 'features':
+        if not features_current(output, nd2_file, well, params['cell_channel'], params['int_channels'], params['background']):
+            cell_features_well(well, nd2_file, params['cell_channel'], params['int_channels'], params['background'])
+    else:
+        plate_ratios(plate)
+    return time.perf_counter()-start
+
+def plate_ratios(plate):
+    # final per plate ratio table, written next to the results zarr.
+    params = plate['params']
+    result_file = nd2_file_2_zarr_result_file(plate['nd2'])
+    invalidate_cell_table(result_file)
+    build_cell_table(result_file)
+    meta_data = read_plate_metadata(plate['metadata'], params['plate_size'])
+    ratios = calculate_scaffold_epi_ratios(plate['nd2'], meta_data, params['scaffold_channel'], params['epi_channel'],
+                                           threshold_factor=params['threshold_factor'], plate_size=params['plate_size'])
+    ratios.insert(0, 'plate', plate['name'])
+    ratios.to_csv(ratio_file(plate), index=False)
+    return ratios
+
+def ratio_file(plate):
+    result_file = nd2_file_2_zarr_result_file(plate['nd2'])
+    return result_file.parents[0]/f"{result_file.stem}_ratios.csv"
+
+def read_plate_metadata(metadata_file, plate_size=96):
+    if metadata_file is None:
+        # every well is kept, with no conditions.
+        return pd.DataFrame({'well': plate_geometry(plate_size).ids})
+    if Path(metadata_file).suffix.lower() == '.xml':
+        return read_plate_xml(metadata_file, plate_size)[0]
+    return read_plate_csv(metadata_file, plate_size)
+
+def run_queue(queue, stage_workers, poll_seconds=1.0, log=print):
+    # schedule ready jobs of every stage within its concurrency limit until nothing is left to run.
+    context = multiprocessing.get_context('spawn')
+    pools = {stage: ProcessPoolExecutor(max_workers=workers, mp_context=context) for stage, workers in stage_workers.items()}
+    running = {}
+    try:
+        while True:
+            for job in queue.fail_blocked():
+                log(f"{job['plate']} well {job['well']} {job['stage']} failed: {job['error']}")
+            for stage, workers in stage_workers.items():
+                in_stage = sum(job['stage'] == stage for job in running.values())
+                for job in queue.claim(stage, workers-in_stage):
+                    plate = queue.plate(job['plate'])
+                    if stage == 'segment':
+                        # masks may be replaced, the plate table is rebuilt by the ratios job.
+                        invalidate_cell_table(nd2_file_2_zarr_result_file(plate['nd2']))
+                    future = pools[stage].submit(run_job, stage, plate, job['well'])
+                    running[future] = job
+            if len(running) == 0:
+                break
+            done, _ = wait(running, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    seconds = future.result()
+                    queue.finish(job, seconds)
+                    log(f"{job['plate']} well {job['well']} {job['stage']} done in {seconds:.1f} s")
+                except Exception as error:
+                    queue.fail(job, repr(error))
+                    log(f"{job['plate']} well {job['well']} {job['stage']} failed: {error!r}")
+    finally:
+        for future in running:
+            future.cancel()
+        for pool in pools.values():
+            pool.shutdown()
+    return queue.status()
@@ -0,0 +1,106 @@
+import numpy as np
+import zarr
+from wellplate.reader import open_plate
+from wellplate.extract import nd2_file_2_zarr_result_file
+from wellplate.parallel import map_wells
+from wellplate.instrument import stage, default_callbacks, MetricsCollector, save_metrics
+from wellplate.table import open_cell_table, read_cells, read_background
+from wellplate.geometry import plate_geometry
+
+ATLAS_PATH = 'qc/sig_cells'
+# overlay class per label: 0 background, 1 significant, 2 not significant.
+CLASS_COLORS = np.array([[0, 0, 0], [0, 128, 0], [255, 0, 0]], np.float32)
+CLASS_ALPHA = np.array([0, 0.25, 0.25], np.float32)
+
+
+def well_sig_cells(proc_data, result_file, well_ind, scaffold_channel, threshold_factor, table=None):
+    # labels of a well's cells and whether each one is above the scaffold background threshold.
+    if table is not None:
+        intensities = read_cells(result_file, well_ind, [f'{scaffold_channel} mean'], table=table)[f'{scaffold_channel} mean'].to_numpy()
+        background_values = read_background(result_file, scaffold_channel, well_ind, table=table)
+    else:
+        intensities = proc_data[f'cells/intensities/well {well_ind}/channel {scaffold_channel}'][:]
+        background_values = proc_data[f'cells/background/well {well_ind}/channel {scaffold_channel}'][:]
+    morphology_path = f'cells/features/well {well_ind}/morphology'
+    if morphology_path in proc_data:
+        labels = proc_data[morphology_path][:, 0].astype(np.int64)
+    else:
+        # older stores without morphology number cells consecutively.
+        labels = np.arange(1, intensities.size+1)
+    threshold = background_values[0]+(threshold_factor*background_values[1])
+    return labels, intensities, intensities > threshold
+
+def class_lut(labels, significant, max_label):
+    # class of every label value, so the mask is classified by a single indexing pass.
+    lut = np.zeros(int(max(max_label, labels.max(initial=0)))+1, np.uint8)
+    lut[labels] = np.where(significant, 1, 2)
+    return lut
+
+def block_mean(im, scale):
+    # scale x scale mean, edges are padded by repeating the last row/column.
+    if scale == 1:
+        return im
+    pad = [(0, -im.shape[0] % scale), (0, -im.shape[1] % scale)]
+    im = np.pad(im, pad, mode='edge')
+    return im.reshape(im.shape[0]//scale, scale, im.shape[1]//scale, scale).mean(axis=(1, 3))
+
+def sig_cell_overlay(im, mask_im, labels, significant, low, high, scale=4):
+    # gray image with significant cells tinted green and the others red, at 1/scale resolution.
+    small = block_mean(im, scale)
+    gray = np.clip((small-low)*(255/max(high-low, 1)), 0, 255).astype(np.float32)
+    classes = class_lut(labels, significant, mask_im.max())[mask_im[::scale, ::scale]]
+    alpha = CLASS_ALPHA[classes][..., None]
+    rgb = gray[..., None]*(1-alpha)+CLASS_COLORS[classes]*alpha
+    return rgb.astype(np.uint8)
+
+def well_overlay(nd2_file, well_ind, dapi_channel, scaffold_channel, threshold_factor=0.5, scale=4, table=None):
+    result_file = nd2_file_2_zarr_result_file(nd2_file)
+    proc_data = zarr.open(result_file, mode='r')
+    reader = open_plate(nd2_file)
+    with stage('read'):
+        im = reader.read(well_ind, scaffold_channel)
+        labels, intensities, significant = well_sig_cells(proc_data, result_file, well_ind, scaffold_channel, threshold_factor, table)
+        mask_im = proc_data[f'cells/masks/well {well_ind}/channel {dapi_channel}'][:]
+    with stage('render'):
+        low, high = (intensities.min(), np.percentile(intensities, 80)) if intensities.size > 0 else (0, 1)
+        return sig_cell_overlay(im, mask_im, labels, significant, low, high, scale)
+
+def thumbnail_shape(reader, scale):
+    return -(-reader.shape[2]//scale), -(-reader.shape[3]//scale)
+
+def sig_cell_atlas(nd2_file, dapi_channel, scaffold_channel, threshold_factor=0.5, scale=8, plate_size=96, workers=1, memory_gb=None,
+                   callbacks=None):
+    # every well's overlay as a thumbnail, tiled in plate layout. each well is exactly one chunk of the atlas,
+    # so wells are rendered and written in parallel.
+    result_file = nd2_file_2_zarr_result_file(nd2_file)
+    output = zarr.open(result_file)
+    reader = open_plate(nd2_file)
+    geometry = plate_geometry(plate_size)
+    height, width = thumbnail_shape(reader, scale)
+    atlas = output.require_group('qc').create_dataset(ATLAS_PATH.split('/')[-1], shape=(geometry.n_rows*height, geometry.n_cols*width, 3),
+                                                      chunks=(height, width, 3), dtype=np.uint8, fill_value=0, overwrite=True)
+    atlas.attrs.update({'scale': scale, 'plate_size': plate_size, 'thumbnail_shape': [height, width], 'wells': reader.shape[0],
+                        'dapi_channel': dapi_channel, 'scaffold_channel': scaffold_channel, 'threshold_factor': threshold_factor})
+    well_nbytes = reader.shape[2]*reader.shape[3]*(reader.dtype.itemsize+4+8)
+    metrics = MetricsCollector()
+    results, timings = map_wells(atlas_well, range(min(reader.shape[0], plate_size)),
+                                 (nd2_file, dapi_channel, scaffold_channel, threshold_factor, scale, plate_size), workers=workers,
+                                 memory_gb=memory_gb, well_nbytes=well_nbytes, desc='Rendering thumbnails',
+                                 callbacks=default_callbacks(callbacks)+[metrics])
+    save_metrics(output, 'atlas', metrics)
+    return atlas
+
+def atlas_well(well_ind, nd2_file, dapi_channel, scaffold_channel, threshold_factor, scale, plate_size):
+    result_file = nd2_file_2_zarr_result_file(nd2_file)
+    thumbnail = well_overlay(nd2_file, well_ind, dapi_channel, scaffold_channel, threshold_factor, scale, open_cell_table(result_file))
+    with stage('write'):
+        atlas = zarr.open(result_file)[ATLAS_PATH]
+        height, width = atlas.attrs['thumbnail_shape']
+        row, col = plate_geometry(plate_size).ind_to_row_col(well_ind)
+        atlas[row*height:(row+1)*height, col*width:(col+1)*width] = thumbnail
+
+def open_atlas(result_file):
+    output = zarr.open(result_file, mode='r')
+    if ATLAS_PATH not in output:
+        return None
+    return output[ATLAS_PATH]
@@ -0,0 +1,53 @@
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from wellplate.instrument import recording, default_callbacks
+
+
+def wells_in_flight(workers, memory_gb=None, well_nbytes=None):
+    # bound the number of wells loaded at the same time by the memory budget.
+    if (memory_gb is None) or (well_nbytes is None) or (well_nbytes == 0):
+        return max(1, workers)
+    return int(max(1, min(workers, (memory_gb*2**30)//well_nbytes)))
+
+def timed_well(well_func, well_ind, args, record=False):
+    start = time.perf_counter()
+    if not record:
+        result = well_func(well_ind, *args)
+        return result, time.perf_counter()-start, []
+    with recording() as spans:
+        result = well_func(well_ind, *args)
+    return result, time.perf_counter()-start, spans
+
+def map_wells(well_func, well_inds, args=(), workers=1, memory_gb=None, well_nbytes=None, desc='Processing well', callbacks=None):
+    # run well_func(well_ind, *args) for every well, sequentially or in a process pool.
+    well_inds = list(well_inds)
+    in_flight = wells_in_flight(workers, memory_gb, well_nbytes)
+    callbacks = default_callbacks(callbacks)
+    record = any(callback.records for callback in callbacks)
+    results = {}
+    timings = []
+    start = time.perf_counter()
+    for callback in callbacks:
+        callback.start(len(well_inds), desc)
+    def well_done(well_ind, result, seconds, spans):
+        results[well_ind] = result
+        timings.append({'well_ind': well_ind, 'seconds': seconds})
+        for callback in callbacks:
+            callback.well_done(well_ind, seconds, spans)
+    if in_flight == 1:
+        for well_ind in well_inds:
+            well_done(well_ind, *timed_well(well_func, well_ind, args, record))
+    else:
+        # every worker holds a single well, so the pool size is the in-flight limit.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=in_flight, mp_context=context) as pool:
+            futures = {pool.submit(timed_well, well_func, well_ind, args, record): well_ind for well_ind in well_inds}
+            for future in as_completed(futures):
+                well_done(futures[future], *future.result())
+    total = time.perf_counter()-start
+    for callback in callbacks:
+        callback.finish(total, in_flight)
+    timings = pd.DataFrame(timings, columns=['well_ind', 'seconds']).sort_values('well_ind', ignore_index=True)
+    return [results[well_ind] for well_ind in well_inds], timings
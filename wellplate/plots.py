@@ -6,15 +6,15 @@ import numpy as np
 import pandas as pd
 import panel as pn
 from bokeh.palettes import Category10
-import nd2
 import napari
 from napari.utils import Colormap
 from bokeh.models import TapTool
-import zarr
 from wellplate.extract import nd2_file_2_zarr_result_file
-from wellplate.elements import read_nd2
+from wellplate.reader import open_plate
+from wellplate.geometry import plate_geometry, PLATE_SHAPES
+from wellplate.table import open_cell_table
+from wellplate.overlay import well_overlay, open_atlas
 import matplotlib.pyplot as plt
-import matplotlib as mpl
 
 def plate_map(meta_data, viewer=None):
     pn.extension()
@@ -35,15 +35,15 @@ class PlateMap(param.Parameterized):
             p.grid.visible = False
             p.toolbar.active_drag = None
             p.toolbar.active_scroll = None
-            if self.well_size == 96:
-                x = np.tile(np.arange(1,13),8)
-                y = (np.array([np.repeat(i,12)for i in range(8)])).flatten()
-                #adjust axis.
-                p.x_range.start, p.x_range.end = 0.5,14.5
-                p.y_range.start, p.y_range.end = 7.5,-0.5
-                p.yaxis.ticker = np.arange(0,9)
-                p.yaxis.major_label_overrides = {0: 'A', 1: 'B', 2: 'C',3:'D',4:'E',5:'F',6:'G',7:'H'}
-                p.xaxis.ticker = np.arange(1,13)
+            geometry = plate_geometry(self.well_size)
+            x = geometry.cols+1
+            y = geometry.rows
+            #adjust axis.
+            p.x_range.start, p.x_range.end = 0.5,geometry.n_cols+2.5
+            p.y_range.start, p.y_range.end = geometry.n_rows-0.5,-0.5
+            p.yaxis.ticker = np.arange(0,geometry.n_rows+1)
+            p.yaxis.major_label_overrides = {i: name for i, name in enumerate(geometry.row_names)}
+            p.xaxis.ticker = np.arange(1,geometry.n_cols+1)
 
             if self.conditions != '':
                 values = self.meta_data[self.conditions].unique()
@@ -66,6 +66,8 @@ class PlateMap(param.Parameterized):
                 # = new[0]
         def set_meta_data(self, meta_data):
             self.meta_data = meta_data
+            if len(meta_data) in PLATE_SHAPES:
+                self.well_size = len(meta_data)
             conditions = [ cond for cond in self.meta_data.columns[1:] if cond not in ['Note','Notes','NOTES']]
             self.param.conditions.objects = conditions
             self.conditions = conditions[0]
@@ -73,51 +75,30 @@ class PlateMap(param.Parameterized):
             self.viewer=viewer
 
 def napari_plate_view(nd2_loc):
-    with nd2.ND2File(nd2_loc) as ndfile:
-        colormaps = []
-        names = []
-        for channel in ndfile.metadata.channels:
-            name = channel.channel.name
-            names.append(name)
-            r = (channel.channel.colorRGB & 0xff)/255
-            g = ((channel.channel.colorRGB & 0xff00) >> 8)/255
-            b = ((channel.channel.colorRGB & 0xff0000) >> 16)/255
-            a = 1
-            colors = [[0,0,0,0],[r,g,b,a]]
-            colormaps.append(Colormap(colors,name = name))
-        xarr = ndfile.to_xarray(delayed=False)
-        return napari.view_image(xarr, channel_axis=1,colormap = colormaps,name=names)
+    # channel metadata comes from the shared reader, wells are read lazily as napari requests them.
+    reader = open_plate(nd2_loc)
+    colormaps = [Colormap([[0,0,0,0],[r,g,b,1]],name = name) for name, (r, g, b) in zip(reader.channel_names, reader.colors)]
+    return napari.view_image(reader.to_xarray(), channel_axis=1,colormap = colormaps,name=list(reader.channel_names))
 
-def show_sig_cell_masks(nd2_file, well_ind, dapi_channel, scaffold_channel, threshold_factor = 0.5 ):
-  # get result zarr file. 
-  result_file = nd2_file_2_zarr_result_file(nd2_file)
-  proc_data = zarr.open(result_file)
-  # read nd2 file.
-  im_data, channel_names, colormaps = read_nd2(nd2_file)
-  channel_ind = channel_names.index(scaffold_channel)
-  # get image.
-  im=im_data[well_ind,channel_ind,:,:].to_numpy()
-  # get intensities.
-  intensities = proc_data[f'cells/intensities/well {well_ind}/channel {scaffold_channel}'][:]
-  # get background values.
-  background_values = proc_data[f'cells/background/well {well_ind}/channel {scaffold_channel}'][:]
-  mean_background = background_values[0]
-  std_background = background_values[1]
-  # THRESHOLD.
-  threshold = mean_background+(threshold_factor*std_background)
-  sig_cells = np.argwhere(intensities>threshold)+1
-  ns_cells = np.argwhere(intensities<=threshold)+1
-  # get mask.
-  mask_im = proc_data[f'cells/masks/well {well_ind}/channel {dapi_channel}'][:]
-  # get significant mask image.
-  sig_mask = np.isin(mask_im,sig_cells)
-  sig_mask = np.ma.masked_equal(sig_mask, False)
-  ns_mask = np.isin(mask_im,ns_cells)
-  ns_mask = np.ma.masked_equal(ns_mask, False)
-  cm_sig = mpl.colors.ListedColormap(['black','green'])
-  cm_ns = mpl.colors.ListedColormap(['black','red'])
+def show_sig_cell_masks(nd2_file, well_ind, dapi_channel, scaffold_channel, threshold_factor = 0.5, scale=4):
+  # overlay is rendered at 1/scale resolution, cells are classified through a per label lookup table.
+  rgb = well_overlay(nd2_file, well_ind, dapi_channel, scaffold_channel, threshold_factor, scale,
+                     open_cell_table(nd2_file_2_zarr_result_file(nd2_file)))
   # make figure.
   fig, ax = plt.subplots(1,1,figsize=(12,12))
-  ax.imshow(im,vmin=intensities.min(),vmax=np.percentile(intensities,80),cmap='gray')
-  ax.imshow(sig_mask, cmap=cm_sig, vmin=0, vmax=1, interpolation='none', alpha=0.25)
-  ax.imshow(ns_mask, cmap=cm_ns, vmin=0, vmax=1, interpolation='none', alpha=0.25)
\ No newline at end of file
+  ax.imshow(rgb, interpolation='none')
+
+def show_sig_cell_atlas(nd2_file, figsize=(16,11)):
+  # plate layout of the thumbnails stored by sig_cell_atlas.
+  atlas = open_atlas(nd2_file_2_zarr_result_file(nd2_file))
+  if atlas is None:
+    raise ValueError(f'No thumbnail atlas stored for {nd2_file}, run sig_cell_atlas first')
+  geometry = plate_geometry(atlas.attrs['plate_size'])
+  height, width = atlas.attrs['thumbnail_shape']
+  fig, ax = plt.subplots(1,1,figsize=figsize)
+  ax.imshow(atlas[:], interpolation='none')
+  ax.set_xticks((np.arange(geometry.n_cols)+0.5)*width)
+  ax.set_xticklabels(np.arange(1,geometry.n_cols+1))
+  ax.set_yticks((np.arange(geometry.n_rows)+0.5)*height)
+  ax.set_yticklabels(geometry.row_names)
+  return fig
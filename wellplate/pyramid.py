@@ -0,0 +1,83 @@
+import numpy as np
+import zarr
+from wellplate.reader import open_plate
+from wellplate.extract import nd2_file_2_zarr_result_file, COMPRESSOR
+from wellplate.parallel import map_wells
+from wellplate.instrument import stage, default_callbacks, MetricsCollector, save_metrics
+from wellplate.fingerprint import fingerprint, run_id
+
+PYRAMID_VERSION = 1
+
+
+def build_pyramid(nd2_file, cell_channel=None, chunk_size=512, redo=False, workers=1, memory_gb=None, callbacks=None):
+    # write every well's channels (and cell mask) as a chunked, compressed multiscale pyramid.
+    result_file = nd2_file_2_zarr_result_file(nd2_file)
+    output = zarr.open(result_file)
+    reader = open_plate(nd2_file)
+    well_inds = [well_ind for well_ind in range(reader.shape[0])
+                 if redo or (output.get(f'pyramid/well {well_ind}') is None)
+                 or (output[f'pyramid/well {well_ind}'].attrs.get('fingerprint') != pyramid_fingerprint(output, nd2_file, well_ind, cell_channel, chunk_size))]
+    output.require_group('pyramid')
+    well_nbytes = reader.shape[1]*reader.shape[2]*reader.shape[3]*reader.dtype.itemsize*2
+    metrics = MetricsCollector()
+    results, timings = map_wells(pyramid_well, well_inds, (nd2_file, cell_channel, chunk_size), workers=workers, memory_gb=memory_gb,
+                                 well_nbytes=well_nbytes, desc='Building pyramid', callbacks=default_callbacks(callbacks)+[metrics])
+    save_metrics(output, 'pyramid', metrics)
+    return timings
+
+def pyramid_fingerprint(output, nd2_file, well_ind, cell_channel, chunk_size):
+    mask_run = None
+    if cell_channel is not None:
+        mask_run = run_id(output, f'cells/masks/well {well_ind}/channel {cell_channel}')
+    return fingerprint(nd2_file, 'pyramid', PYRAMID_VERSION, cell_channel=cell_channel, mask=mask_run, chunk_size=chunk_size)
+
+def pyramid_well(well_ind, nd2_file, cell_channel, chunk_size):
+    output = zarr.open(nd2_file_2_zarr_result_file(nd2_file))
+    reader = open_plate(nd2_file)
+    with stage('read'):
+        image = reader.read(well_ind)
+        mask = None
+        if cell_channel is not None:
+            mask = output[f'cells/masks/well {well_ind}/channel {cell_channel}'][:]
+    # write levels until a whole well fits in a single chunk.
+    well_group = output.create_group(f'pyramid/well {well_ind}', overwrite=True)
+    level = 0
+    while True:
+        with stage('write'):
+            well_group.create_dataset(f'image/{level}', data=image, chunks=(1, chunk_size, chunk_size), compressor=COMPRESSOR)
+            if mask is not None:
+                well_group.create_dataset(f'mask/{level}', data=mask, chunks=(chunk_size, chunk_size), compressor=COMPRESSOR)
+        if max(image.shape[-2:]) <= chunk_size:
+            break
+        with stage('downsample'):
+            image = downsample_image(image)
+            if mask is not None:
+                mask = mask[::2, ::2]
+        level += 1
+    well_group.attrs.update({'levels': level+1, 'shape': list(reader.shape[-2:]), 'channels': list(reader.channel_names),
+                             'fingerprint': pyramid_fingerprint(output, nd2_file, well_ind, cell_channel, chunk_size)})
+
+def downsample_image(image):
+    # 2x2 mean, odd edges are padded by repeating the last row/column.
+    pad = [(0, 0)]*(image.ndim-2)+[(0, image.shape[-2] % 2), (0, image.shape[-1] % 2)]
+    image = np.pad(image, pad, mode='edge')
+    blocks = image.reshape(image.shape[:-2]+(image.shape[-2]//2, 2, image.shape[-1]//2, 2))
+    return blocks.mean(axis=(-3, -1)).astype(image.dtype)
+
+def open_pyramid(result_file, well_ind):
+    output = zarr.open(result_file, mode='r')
+    if f'pyramid/well {well_ind}' not in output:
+        return None
+    return output[f'pyramid/well {well_ind}']
+
+def choose_level(well_pyramid, region_shape, display_shape):
+    # coarsest level that still has at least one pixel per display pixel.
+    scale = min(region_shape[0]/display_shape[0], region_shape[1]/display_shape[1])
+    level = int(np.floor(np.log2(max(scale, 1))))
+    return min(level, well_pyramid.attrs['levels']-1)
+
+def read_region(well_pyramid, kind, level, y0, y1, x0, x1):
+    # region in full resolution pixel coordinates, returned at the given level.
+    factor = 2**level
+    array = well_pyramid[f'{kind}/{level}']
+    return array[..., y0//factor:-(-y1//factor), x0//factor:-(-x1//factor)]
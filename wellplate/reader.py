@@ -0,0 +1,182 @@
+import os
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+import xarray as xr
+import dask.array as da
+import zarr
+import nd2
+from matplotlib.colors import LinearSegmentedColormap
+from wellplate.fingerprint import file_identity
+
+# open plate files kept per process, least recently used ones are closed first.
+MAX_OPEN = 8
+
+_readers = OrderedDict()
+_readers_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def channel_colormap(color):
+    # black to channel color over the full uint16 range.
+    return LinearSegmentedColormap.from_list('testCmap', [[0, 0, 0], list(color)], N=2**16)
+
+def channel_color(channel):
+    rgb = channel.channel.colorRGB
+    return ((rgb & 0xff)/255, ((rgb & 0xff00) >> 8)/255, ((rgb & 0xff0000) >> 16)/255)
+
+class PlateReader():
+    # (well, channel, y, x) access to a plate, subclasses implement read_well_frame.
+    channel_names = []
+    colors = []
+    shape = (0, 0, 0, 0)
+    dtype = np.dtype(np.uint16)
+    def __init__(self):
+        self.lock = threading.Lock()
+    @property
+    def colormaps(self):
+        return [channel_colormap(color) for color in self.colors]
+    def channel_index(self, channels):
+        # channel names or indices, a single channel gives a 2D result.
+        if channels is None:
+            return slice(None)
+        if isinstance(channels, (list, tuple, np.ndarray)):
+            return [self.channel_index(channel) for channel in channels]
+        return self.channel_names.index(channels) if isinstance(channels, str) else int(channels)
+    def read(self, well_ind, channels=None, y0=0, y1=None, x0=0, x1=None):
+        with self.lock:
+            frame = self.read_well_frame(int(well_ind))
+            return np.array(frame[self.channel_index(channels), y0:y1, x0:x1])
+    def read_wells(self, well_inds, channels=None, y0=0, y1=None, x0=0, x1=None):
+        return np.stack([self.read(well_ind, channels, y0, y1, x0, x1) for well_ind in well_inds])
+    def read_well_frame(self, well_ind):
+        raise NotImplementedError
+    def to_xarray(self):
+        raise NotImplementedError
+    def close(self):
+        pass
+
+class ND2Reader(PlateReader):
+    # one open ND2 file, channel metadata is parsed once when the file is opened.
+    def __init__(self, file_loc):
+        super().__init__()
+        self.file = nd2.ND2File(file_loc)
+        self.channel_names = [channel.channel.name for channel in self.file.metadata.channels]
+        self.colors = [channel_color(channel) for channel in self.file.metadata.channels]
+        sizes = dict(self.file.sizes)
+        # every loop other than positions is expected to have a single entry in plate scans.
+        self.loop_shape = tuple(size for dim, size in sizes.items() if dim not in ('C', 'Y', 'X', 'S'))
+        self.loop_dims = [dim for dim in sizes if dim not in ('C', 'Y', 'X', 'S')]
+        self.shape = (sizes.get('P', 1), sizes.get('C', 1), sizes['Y'], sizes['X'])
+        self.dtype = np.dtype(self.file.dtype)
+        self._xarray = None
+    def read_well_frame(self, well_ind):
+        coords = [well_ind if dim == 'P' else 0 for dim in self.loop_dims]
+        frame_index = int(np.ravel_multi_index(coords, self.loop_shape)) if len(coords) > 0 else 0
+        frame = self.file.read_frame(frame_index)
+        return frame.reshape((-1,)+frame.shape[-2:])
+    def to_xarray(self):
+        # delayed reads go through the handle that is already open.
+        if self._xarray is None:
+            self._xarray = self.file.to_xarray(delayed=True)
+        return self._xarray
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class ArrayReader(PlateReader):
+    # in memory (well, channel, y, x) data, e.g. synthetic plates.
+    def __init__(self, data, channel_names, colors):
+        super().__init__()
+        self.data = data
+        self.channel_names = list(channel_names)
+        self.colors = [tuple(color) for color in colors]
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(data.dtype)
+    def read_well_frame(self, well_ind):
+        return np.asarray(self.data[well_ind])
+    def to_xarray(self):
+        if isinstance(self.data, xr.DataArray):
+            return self.data
+        return xr.DataArray(self.data, dims=['P', 'C', 'Y', 'X'])
+
+class ZarrPlateReader(PlateReader):
+    # transcoded copy of a plate, region reads only decompress the chunks they touch.
+    def __init__(self, file_loc):
+        super().__init__()
+        self.root = zarr.open(str(file_loc), mode='r')
+        self.array = self.root['image']
+        self.channel_names = list(self.root.attrs['channel_names'])
+        self.colors = [tuple(color) for color in self.root.attrs['colors']]
+        self.shape = tuple(self.array.shape)
+        self.dtype = np.dtype(self.array.dtype)
+    def read(self, well_ind, channels=None, y0=0, y1=None, x0=0, x1=None):
+        # zarr reads are thread safe, no lock needed.
+        return self.array.get_orthogonal_selection((int(well_ind), self.channel_index(channels), slice(y0, y1), slice(x0, x1)))
+    def read_well_frame(self, well_ind):
+        return self.array[int(well_ind)]
+    def to_xarray(self):
+        return xr.DataArray(da.from_zarr(self.array), dims=['P', 'C', 'Y', 'X'])
+
+def transcoded_file(file_loc):
+    file_loc = Path(file_loc)
+    return file_loc.parents[0]/f"{file_loc.stem}.raw.zarr"
+
+def transcoded_complete(file_loc):
+    # a finished transcode of the current version of the source file.
+    target = transcoded_file(file_loc)
+    if not (target/'.zattrs').exists():
+        return False
+    attrs = zarr.open(str(target), mode='r').attrs
+    return attrs.get('complete', False) and (attrs.get('source') == file_identity(file_loc))
+
+def file_key(file_loc, transcoded=True):
+    # changes when the source file or its transcoded copy changes.
+    stat = os.stat(file_loc)
+    attrs_file = transcoded_file(file_loc)/'.zattrs'
+    transcoded_mtime = attrs_file.stat().st_mtime_ns if (transcoded and attrs_file.exists()) else None
+    return stat.st_mtime_ns, stat.st_size, transcoded_mtime
+
+def open_plate(file_loc, transcoded=True):
+    # pooled reader per file, the transcoded zarr copy is used when it is complete and up to date.
+    path = str(Path(file_loc).resolve())
+    pool_key = (path, transcoded)
+    with _readers_lock:
+        entry = _readers.get(pool_key)
+        if (entry is None) or ((entry[0] is not None) and (entry[0] != file_key(path, transcoded))):
+            if entry is not None:
+                entry[1].close()
+            if transcoded and transcoded_complete(path):
+                reader = ZarrPlateReader(transcoded_file(path))
+            else:
+                reader = ND2Reader(path)
+            entry = (file_key(path, transcoded), reader)
+            _readers[pool_key] = entry
+        _readers.move_to_end(pool_key)
+        opened = [opened_key for opened_key, (key, reader) in _readers.items() if key is not None]
+        for evicted_key in opened[:max(0, len(opened)-MAX_OPEN)]:
+            _readers.pop(evicted_key)[1].close()
+        return entry[1]
+
+def register_reader(file_loc, reader):
+    # serve a custom reader for a path in this process, it is never evicted or reopened.
+    path = str(Path(file_loc).resolve())
+    with _readers_lock:
+        for transcoded in [True, False]:
+            _readers[(path, transcoded)] = (None, reader)
+
+def close_plates():
+    with _readers_lock:
+        for key, reader in _readers.values():
+            reader.close()
+        _readers.clear()
+
+def release_plate(file_loc):
+    path = str(Path(file_loc).resolve())
+    with _readers_lock:
+        entries = [_readers.pop((path, transcoded), None) for transcoded in [True, False]]
+    for entry in entries:
+        if entry is not None:
+            entry[1].close()
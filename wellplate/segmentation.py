@@ -0,0 +1,123 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage as ndi
+from skimage import filters, feature, segmentation
+
+# nuclei diameter in pixels when none is given, same as the cellpose nuclei model.
+DEFAULT_DIAMETER = 17
+# tile size the classical engine splits wells into, tiles of a batch are segmented in parallel threads.
+CLASSICAL_TILE_SIZE = 1024
+
+# loaded models shared by every call in this process, keyed by (model_type, device).
+_models = {}
+_models_lock = threading.Lock()
+
+
+def resolve_device(gpu=None):
+    # None uses the GPU when torch can see one, False forces CPU. torch and cellpose are only needed by the cellpose engine.
+    if gpu is None:
+        from cellpose import core
+        gpu = core.use_gpu()
+    return 'gpu' if gpu else 'cpu'
+
+def set_cpu_threads(threads=None):
+    # torch defaults to fewer threads than cores on some platforms, use them all unless told otherwise.
+    import torch
+    threads = threads or os.cpu_count() or 1
+    if torch.get_num_threads() != threads:
+        torch.set_num_threads(threads)
+    return threads
+
+def cellpose_model(model_type='nuclei', gpu=None, threads=None):
+    device = resolve_device(gpu)
+    key = (model_type, device)
+    with _models_lock:
+        if key not in _models:
+            from cellpose import models
+            _models[key] = models.Cellpose(gpu=(device == 'gpu'), model_type=model_type)
+    if device == 'cpu':
+        set_cpu_threads(threads)
+    return _models[key]
+
+def clear_models():
+    with _models_lock:
+        _models.clear()
+
+def cellpose_segment(images, model_type='nuclei', gpu=None, threads=None, batch_size=8, **eval_params):
+    # one eval call for a list of 2D images, cellpose batches their network tiles together.
+    model = cellpose_model(model_type, gpu, threads)
+    masks, flows, styles, diams = model.eval(list(images), batch_size=batch_size, **eval_params)
+    return list(masks)
+
+def classical_segment(images, diameter=None, sigma=1.0, threshold='otsu', threshold_value=None, block_size=101, offset=0.0,
+                      min_size=None, threads=None):
+    # smoothing, threshold, distance transform and seeded watershed, images are processed in parallel threads.
+    segment = lambda image: classical_segment_image(image, diameter, sigma, threshold, threshold_value, block_size, offset, min_size)
+    images = list(images)
+    if len(images) == 1:
+        return [segment(images[0])]
+    with ThreadPoolExecutor(max_workers=min(threads or os.cpu_count() or 1, len(images))) as pool:
+        return list(pool.map(segment, images))
+
+def classical_segment_image(image, diameter=None, sigma=1.0, threshold='otsu', threshold_value=None, block_size=101, offset=0.0,
+                            min_size=None):
+    diameter = diameter or DEFAULT_DIAMETER
+    smoothed = ndi.gaussian_filter(np.asarray(image, dtype=np.float32), sigma)
+    if threshold == 'local':
+        foreground = smoothed > filters.threshold_local(smoothed, block_size, offset=-offset)
+    else:
+        foreground = smoothed > (threshold_value if threshold_value is not None else filters.threshold_otsu(smoothed))
+    # drop specks well below nucleus size.
+    min_size = min_size if min_size is not None else int(np.pi*(diameter/4)**2)
+    components, n_components = ndi.label(foreground)
+    small = np.bincount(components.ravel()) < min_size
+    small[0] = False
+    components[small[components]] = 0
+    foreground = components > 0
+    if not foreground.any():
+        return np.zeros(foreground.shape, np.int32)
+    # one seed per distance maximum, touching nuclei are split along the distance ridge.
+    distance = ndi.distance_transform_edt(foreground)
+    peaks = feature.peak_local_max(distance, min_distance=max(1, int(diameter/4)), labels=components, exclude_border=False)
+    markers = np.zeros(foreground.shape, np.int32)
+    markers[tuple(peaks.T)] = np.arange(1, len(peaks)+1)
+    return segmentation.watershed(-distance, markers, mask=foreground).astype(np.int32)
+
+def well_threshold(sample, sigma=1.0):
+    # otsu threshold of a (subsampled) whole well, so tiles without nuclei are not split at noise level.
+    return float(filters.threshold_otsu(ndi.gaussian_filter(np.asarray(sample, dtype=np.float32), sigma)))
+
+# segmentation engines take a list of 2D images and return a label image per image.
+ENGINES = {'cellpose': cellpose_segment, 'classical': classical_segment}
+
+def segment_images(images, engine='cellpose', **params):
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown segmentation engine {engine}, expected one of {list(ENGINES)}')
+    return ENGINES[engine](images, **params)
+
+def tile_params(engine, params, read_sample):
+    # well wide statistics an engine needs before the well is split into tiles.
+    if (engine == 'classical') and (params.get('threshold', 'otsu') == 'otsu') and (params.get('threshold_value') is None):
+        return dict(params, threshold_value=well_threshold(read_sample(), params.get('sigma', 1.0)))
+    return params
+
+def mask_agreement(labels, reference, iou_threshold=0.5):
+    # one to one matching of cells by IoU, any IoU above 0.5 can only match a single cell.
+    labels, reference = np.asarray(labels).astype(np.int64), np.asarray(reference).astype(np.int64)
+    areas = np.bincount(labels.ravel())
+    reference_areas = np.bincount(reference.ravel())
+    n_labels, n_reference = int(np.count_nonzero(areas[1:])), int(np.count_nonzero(reference_areas[1:]))
+    both = (labels > 0) & (reference > 0)
+    pairs, intersections = np.unique(labels[both]*reference_areas.size+reference[both], return_counts=True)
+    label_ids, reference_ids = np.divmod(pairs, reference_areas.size)
+    ious = intersections/(areas[label_ids]+reference_areas[reference_ids]-intersections)
+    matched = ious > iou_threshold
+    n_matched = int(matched.sum())
+    precision = n_matched/n_labels if n_labels > 0 else np.nan
+    recall = n_matched/n_reference if n_reference > 0 else np.nan
+    return {'cells': n_labels, 'reference_cells': n_reference, 'matched': n_matched, 'precision': precision, 'recall': recall,
+            'f1': 2*n_matched/(n_labels+n_reference) if (n_labels+n_reference) > 0 else np.nan,
+            'mean_iou': float(ious[matched].mean()) if n_matched > 0 else np.nan,
+            'foreground_iou': float(both.sum()/max(((labels > 0) | (reference > 0)).sum(), 1))}
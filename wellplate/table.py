@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import zarr
+
+TABLE_PATH = 'cells/table'
+# kept inside the table group, so deleting the table also deletes its consolidated metadata.
+METADATA_KEY = f'{TABLE_PATH}/.zmetadata'
+CHUNK_ROWS = 2**21
+
+
+def build_cell_table(result_file):
+    # gather the per well arrays into contiguous plate wide columns (CSR layout).
+    output = zarr.open(result_file)
+    if 'cells/intensities' not in output:
+        return None
+    n_wells = len(list(output['cells/intensities'].group_keys()))
+    channels = [name.replace('channel ', '', 1) for name in output['cells/intensities/well 0'].array_keys()]
+    columns = {}
+    backgrounds = {channel: [] for channel in channels}
+    background_tiles = {channel: [] for channel in channels}
+    counts = []
+    for well_ind in range(n_wells):
+        well_columns = {}
+        morphology_path = f'cells/features/well {well_ind}/morphology'
+        if morphology_path in output:
+            morphology = output[morphology_path]
+            for i, name in enumerate(morphology.attrs['columns']):
+                well_columns[name] = morphology[:, i]
+        for channel in channels:
+            feature_path = f'cells/features/well {well_ind}/channel {channel}'
+            if feature_path in output:
+                features = output[feature_path]
+                values = features[:]
+                for i, name in enumerate(features.attrs['columns']):
+                    well_columns[f'{channel} {name}'] = values[:, i]
+            else:
+                well_columns[f'{channel} mean'] = output[f'cells/intensities/well {well_ind}/channel {channel}'][:]
+            backgrounds[channel].append(output[f'cells/background/well {well_ind}/channel {channel}'][:])
+            tiles_path = f'cells/background_tiles/well {well_ind}/channel {channel}'
+            if tiles_path in output:
+                background_tiles[channel].append(output[tiles_path])
+        counts.append(well_columns[f'{channels[0]} mean'].shape[0])
+        for name, values in well_columns.items():
+            columns.setdefault(name, []).append(values)
+    # write.
+    table = output.create_group(TABLE_PATH, overwrite=True)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype('i8')
+    table.create_dataset('offsets', data=offsets, chunks=offsets.shape)
+    for name, values in columns.items():
+        values = np.concatenate(values)
+        table.create_dataset(f'columns/{name}', data=values, chunks=(CHUNK_ROWS,), dtype='f')
+    for channel, values in backgrounds.items():
+        # older stores only hold mean and std.
+        values = np.array([well_values[:min(map(len, values))] for well_values in values])
+        table.create_dataset(f'background/{channel}', data=values, chunks=values.shape, dtype='f')
+        if len(background_tiles[channel]) == n_wells:
+            tiles = np.stack([well_tiles[:] for well_tiles in background_tiles[channel]])
+            array = table.create_dataset(f'background_tiles/{channel}', data=tiles, chunks=tiles.shape, dtype='f')
+            array.attrs['tile_size'] = background_tiles[channel][0].attrs['tile_size']
+    table.attrs.update({'channels': channels, 'columns': list(columns)})
+    zarr.consolidate_metadata(output.store, metadata_key=METADATA_KEY, path=TABLE_PATH)
+    return table
+
+def invalidate_cell_table(result_file):
+    output = zarr.open(result_file)
+    if TABLE_PATH in output:
+        del output[TABLE_PATH]
+
+def open_cell_table(result_file):
+    # all metadata comes from a single .zmetadata read.
+    try:
+        return zarr.open_consolidated(zarr.DirectoryStore(str(result_file)), metadata_key=METADATA_KEY, path=TABLE_PATH, mode='r')
+    except (KeyError, ValueError):
+        return None
+
+def read_cells(result_file, well_ind=None, columns=None, table=None):
+    if table is None:
+        table = open_cell_table(result_file)
+    offsets = table['offsets'][:]
+    if columns is None:
+        columns = table.attrs['columns']
+    if well_ind is None:
+        rows = slice(None)
+        well_inds = np.repeat(np.arange(offsets.size-1), np.diff(offsets))
+    else:
+        rows = slice(offsets[well_ind], offsets[well_ind+1])
+        well_inds = np.full(offsets[well_ind+1]-offsets[well_ind], well_ind)
+    cells = pd.DataFrame({name: table[f'columns/{name}'][rows] for name in columns})
+    cells.insert(0, 'well_ind', well_inds)
+    return cells
+
+def read_background(result_file, channel, well_ind=None, table=None):
+    # columns start with background mean and std.
+    if table is None:
+        table = open_cell_table(result_file)
+    background = table[f'background/{channel}']
+    if well_ind is None:
+        return background[:]
+    return background[well_ind]
+
+def local_cell_background(result_file, channel, table=None):
+    # background of the tile each cell's centroid falls in, one row per cell.
+    if table is None:
+        table = open_cell_table(result_file)
+    if f'background_tiles/{channel}' not in table:
+        raise ValueError(f'No local background tiles stored for channel {channel}')
+    tiles = table[f'background_tiles/{channel}']
+    tile_size = tiles.attrs['tile_size']
+    tiles = tiles[:]
+    offsets = table['offsets'][:]
+    well_inds = np.repeat(np.arange(offsets.size-1), np.diff(offsets))
+    tile_y = (table['columns/centroid_y'][:]//tile_size).astype(int)
+    tile_x = (table['columns/centroid_x'][:]//tile_size).astype(int)
+    local = tiles[well_inds, tile_y, tile_x]
+    # tiles without background pixels fall back to the well background.
+    well_background = table[f'background/{channel}'][:][well_inds, :local.shape[1]]
+    return np.where(np.isnan(local), well_background, local)
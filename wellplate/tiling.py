@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def tile_grid(shape, tile_size):
+    # core (non-overlapping) tile boundaries in raster order.
+    tiles = []
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            tiles.append((y0, min(y0+tile_size, shape[0]), x0, min(x0+tile_size, shape[1])))
+    return tiles
+
+def segment_tiled(read_region, segment, shape, out_array, tile_size=2048, overlap=128, min_overlap=0.5, batch_tiles=1):
+    # read_region(y0, y1, x0, x1) returns image data, segment(images) returns a label image per image in the list.
+    # out_array should be chunked by tile_size so every core tile is a whole chunk write.
+    tiles = [(y0, y1, x0, x1, max(y0-overlap, 0), min(y1+overlap, shape[0]), max(x0-overlap, 0), min(x1+overlap, shape[1]))
+             for y0, y1, x0, x1 in tile_grid(shape, tile_size)]
+    parents = [0]
+    for batch_start in range(0, len(tiles), batch_tiles):
+        # segment a batch of tiles with some context around them in one call, then stitch them in raster order.
+        batch = tiles[batch_start:batch_start+batch_tiles]
+        batch_labels = segment([read_region(ey0, ey1, ex0, ex1) for y0, y1, x0, x1, ey0, ey1, ex0, ex1 in batch])
+        for (y0, y1, x0, x1, ey0, ey1, ex0, ex1), local in zip(batch, batch_labels):
+            stitch_tile(np.asarray(local), out_array, parents, y0, y1, x0, x1, ey0, ex0, ex1, min_overlap)
+    # resolve merged labels to consecutive IDs and rewrite chunk by chunk.
+    roots = np.array([find_root(parents, label) for label in range(len(parents))])
+    unique_roots, relabel = np.unique(roots, return_inverse=True)
+    relabel = relabel.astype(out_array.dtype)
+    for y0, y1, x0, x1 in tile_grid(shape, tile_size):
+        out_array[y0:y1, x0:x1] = relabel[out_array[y0:y1, x0:x1]]
+    return unique_roots.size-1
+
+def stitch_tile(local, out_array, parents, y0, y1, x0, x1, ey0, ex0, ex1, min_overlap):
+    core = local[y0-ey0:y1-ey0, x0-ex0:x1-ex0]
+    # give labels in the core new global IDs.
+    core_labels = np.unique(core)
+    core_labels = core_labels[core_labels > 0]
+    lut = np.zeros(int(local.max())+1, dtype=np.int64)
+    lut[core_labels] = np.arange(len(parents), len(parents)+core_labels.size)
+    parents.extend(range(len(parents), len(parents)+core_labels.size))
+    # stitch to already written neighbors (above incl. diagonals, and left).
+    if y0 > ey0:
+        written = out_array[ey0:y0, ex0:ex1]
+        match_seam(local[:y0-ey0, :], written, lut, parents, min_overlap)
+    if x0 > ex0:
+        written = out_array[y0:y1, ex0:x0]
+        match_seam(local[y0-ey0:y1-ey0, :x0-ex0], written, lut, parents, min_overlap)
+    out_array[y0:y1, x0:x1] = lut[core]
+
+def match_seam(local_strip, written_strip, lut, parents, min_overlap):
+    # a cell that extends past the core overlaps the neighbor's labels in the strip.
+    both = (local_strip > 0) & (written_strip > 0)
+    if not both.any():
+        return
+    local_ids = local_strip[both].astype(np.int64)
+    written_ids = written_strip[both].astype(np.int64)
+    pairs, counts = np.unique(np.stack([local_ids, written_ids]), axis=1, return_counts=True)
+    # best matching neighbor label per local label.
+    order = np.lexsort((-counts, pairs[0]))
+    pairs, counts = pairs[:, order], counts[order]
+    first = np.flatnonzero(np.diff(pairs[0], prepend=-1))
+    local_sizes = np.bincount(local_strip.ravel().astype(np.int64), minlength=lut.size)
+    for local_id, written_id, count in zip(pairs[0, first], pairs[1, first], counts[first]):
+        if (lut[local_id] > 0) and (count >= min_overlap*local_sizes[local_id]):
+            union(parents, lut[local_id], written_id)
+
+def find_root(parents, label):
+    root = label
+    while parents[root] != root:
+        root = parents[root]
+    # path compression.
+    while parents[label] != root:
+        parents[label], label = root, parents[label]
+    return root
+
+def union(parents, a, b):
+    root_a, root_b = find_root(parents, int(a)), find_root(parents, int(b))
+    if root_a != root_b:
+        parents[max(root_a, root_b)] = min(root_a, root_b)
@@ -0,0 +1,47 @@
+import zarr
+from wellplate.reader import open_plate, transcoded_file, transcoded_complete, release_plate
+from wellplate.parallel import map_wells
+from wellplate.instrument import stage, default_callbacks
+from wellplate.fingerprint import file_identity
+from wellplate.extract import COMPRESSOR
+
+TRANSCODE_VERSION = 1
+
+
+def transcode_plate(nd2_file, chunk_size=1024, redo=False, workers=1, memory_gb=None, callbacks=None):
+    # one time copy of the ND2 into a (well, channel, y, x) zarr next to it, open_plate prefers it once complete.
+    # every chunk holds a single well and channel, so wells are written in parallel without sharing chunks.
+    target = transcoded_file(nd2_file)
+    if (not redo) and transcoded_complete(nd2_file):
+        return target
+    source = open_plate(nd2_file, transcoded=False)
+    settings = {'source': file_identity(nd2_file), 'version': TRANSCODE_VERSION, 'chunk_size': chunk_size}
+    output = zarr.open(str(target))
+    current = (not redo) and ('image' in output) and all(output.attrs.get(key) == value for key, value in settings.items())
+    if not current:
+        output = zarr.open(str(target), mode='w')
+        output.create_dataset('image', shape=source.shape, dtype=source.dtype, chunks=(1, 1, chunk_size, chunk_size),
+                              compressor=COMPRESSOR)
+        # per well completion flags, one chunk each so workers never write the same chunk.
+        output.create_dataset('done', shape=(source.shape[0],), dtype=bool, chunks=(1,), fill_value=False)
+        output.attrs.update(dict(settings, complete=False, channel_names=list(source.channel_names),
+                                 colors=[list(color) for color in source.colors]))
+    # an interrupted transcode continues with the wells that are missing.
+    done = output['done'][:]
+    well_inds = [well_ind for well_ind in range(source.shape[0]) if not done[well_ind]]
+    well_nbytes = source.shape[1]*source.shape[2]*source.shape[3]*source.dtype.itemsize
+    map_wells(transcode_well, well_inds, (nd2_file,), workers=workers, memory_gb=memory_gb, well_nbytes=well_nbytes,
+              desc='Transcoding', callbacks=default_callbacks(callbacks))
+    output.attrs['complete'] = bool(output['done'][:].all())
+    # pooled readers of this plate pick up the transcoded copy on their next open.
+    release_plate(nd2_file)
+    return target
+
+def transcode_well(well_ind, nd2_file):
+    output = zarr.open(str(transcoded_file(nd2_file)))
+    reader = open_plate(nd2_file, transcoded=False)
+    with stage('read'):
+        image = reader.read(well_ind)
+    with stage('write'):
+        output['image'][well_ind] = image
+        output['done'][well_ind] = True